@@ -1,33 +1,673 @@
-from flask import Flask, render_template, jsonify, request, session, redirect, url_for
-from flask_socketio import SocketIO, emit
-import json
-from datetime import datetime
 import os
+
+# Multi-worker mode relays socket.io events through a message queue, whose
+# client must cooperate with eventlet; patch before anything else is imported
+MESSAGE_QUEUE = os.environ.get('POSTIBLE_MESSAGE_QUEUE')
+if MESSAGE_QUEUE:
+    import eventlet
+    eventlet.monkey_patch()
+
+from flask import (Flask, render_template, jsonify, request, session, redirect, url_for, g,
+                   stream_with_context, send_from_directory)
+from werkzeug.utils import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
+from flask_socketio import SocketIO, emit, join_room, leave_room, rooms
+import json
+from datetime import datetime, timedelta
 import hashlib
+import hmac
+import gzip
+import zlib
+import mimetypes
+import base64
 import sqlite3
 from pathlib import Path
 
 
 import random
+import re
 import string
-from time import sleep
-import requests
 from html import unescape
+from urllib.parse import urlparse
 
-from threading import Thread
+from threading import Thread, Lock, Event, Condition, current_thread, main_thread
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import sys
 import time
+import math
+import queue
+import signal
+import atexit
+import fcntl
+from functools import wraps
 
+# Optional: offered to clients that accept it when installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-app = Flask(__name__)
-app.secret_key = os.urandom(24)
-socketio = SocketIO(app, cors_allowed_origins="*")
 
 # Ensure the db directory exists
 Path("db").mkdir(exist_ok=True)
 
+SECRET_KEY_PATH = Path('db/secret_key')
+
+def load_secret_key():
+    """Return the session signing key shared by every worker.
+
+    POSTIBLE_SECRET_KEY wins if set; otherwise a key is generated once and
+    kept in db/secret_key, so sessions survive restarts.
+    """
+    key = os.environ.get('POSTIBLE_SECRET_KEY')
+    if key:
+        return key
+    if not SECRET_KEY_PATH.exists():
+        # Write then link, so a worker racing us never reads a partial key
+        tmp_path = SECRET_KEY_PATH.with_name(f'secret_key.{os.getpid()}')
+        tmp_path.write_text(os.urandom(32).hex())
+        try:
+            os.link(tmp_path, SECRET_KEY_PATH)
+        except FileExistsError:
+            pass
+        finally:
+            tmp_path.unlink()
+    return SECRET_KEY_PATH.read_text().strip()
+
+app = Flask(__name__)
+app.secret_key = load_secret_key()
+# jsonify pretty-prints in debug mode otherwise
+app.json.compact = True
+socketio = SocketIO(app, cors_allowed_origins="*", message_queue=MESSAGE_QUEUE)
+# Reverse proxies or load balancers in front of the app whose
+# X-Forwarded-For and X-Forwarded-Proto are trusted, so rate limits see
+# the client's address rather than the proxy's; 0 trusts none
+TRUSTED_PROXIES = int(os.environ.get('POSTIBLE_TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+# Bearer token for POST /jobs/<name>/<action>; without one, only direct
+# requests from this machine may control jobs
+JOBS_TOKEN = os.environ.get('POSTIBLE_JOBS_TOKEN')
+
+# Histogram buckets in seconds
+REQUEST_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+
+class Metrics:
+    """In-process counters, gauges and histograms in Prometheus text format"""
+
+    def __init__(self):
+        self._lock = Lock()
+        # name -> (type, help, buckets, {label tuple: value})
+        self._families = OrderedDict()
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self._families[name] = (kind, help_text, buckets, {})
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            samples = self._families[name][3]
+            samples[labels] = samples.get(labels, 0) + value
+
+    def set(self, name, value, labels=()):
+        with self._lock:
+            self._families[name][3][labels] = value
+
+    def observe(self, name, value, labels=()):
+        with self._lock:
+            _, _, buckets, samples = self._families[name]
+            counts = samples.get(labels)
+            if counts is None:
+                # One slot per bucket, then +Inf, sum and count
+                counts = samples[labels] = [0] * (len(buckets) + 3)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-3] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs:
+            return ''
+        escaped = (
+            (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in pairs)
+        return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, buckets, samples) in self._families.items():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples.items():
+                    if kind != 'histogram':
+                        lines.append(f'{name}{self._labels(labels)} {value}')
+                        continue
+                    for bound, count in zip(buckets + ('+Inf',), value):
+                        lines.append(f'{name}_bucket{self._labels(labels + (("le", bound),))} {count}')
+                    lines.append(f'{name}_sum{self._labels(labels)} {value[-2]}')
+                    lines.append(f'{name}_count{self._labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('postible_http_request_duration_seconds', 'histogram',
+                 'Time spent handling HTTP requests', REQUEST_BUCKETS)
+metrics.describe('postible_sql_duration_seconds', 'histogram',
+                 'Time spent executing and fetching SQL statements', SQL_BUCKETS)
+metrics.describe('postible_sql_rows_total', 'counter',
+                 'Rows returned or changed by SQL statements')
+metrics.describe('postible_slow_queries_total', 'counter',
+                 'SQL statements slower than the slow-query threshold')
+metrics.describe('postible_socketio_emits_total', 'counter',
+                 'socket.io frames sent')
+metrics.describe('postible_socketio_emit_bytes_total', 'counter',
+                 'JSON payload bytes of socket.io frames sent')
+metrics.describe('postible_content_fetch_duration_seconds', 'histogram',
+                 'Time spent fetching content from external sources', REQUEST_BUCKETS)
+metrics.describe('postible_content_buffer_items', 'gauge',
+                 'Items waiting in the content buffer')
+metrics.describe('postible_feed_cache_lookups_total', 'counter',
+                 'Feed cache lookups by result')
+metrics.describe('postible_user_cache_lookups_total', 'counter',
+                 'User id/username cache lookups by result')
+metrics.describe('postible_post_write_transactions_total', 'counter',
+                 'Transactions committed by the batched post writer')
+metrics.describe('postible_posts_written_total', 'counter',
+                 'Posts inserted by the batched post writer')
+metrics.describe('postible_rate_limit_decisions_total', 'counter',
+                 'Rate-limited requests by rule and result')
+metrics.describe('postible_job_runs_total', 'counter',
+                 'Background job runs by job and result')
+metrics.describe('postible_job_duration_seconds', 'histogram',
+                 'Time spent running background jobs', REQUEST_BUCKETS)
+metrics.describe('postible_like_updates_collapsed_total', 'counter',
+                 'Like updates dropped because the count ended where it started')
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('postible_http_request_duration_seconds',
+                        time.perf_counter() - g.request_start,
+                        (('route', route), ('method', request.method),
+                         ('status', response.status_code)))
+    return response
+
+# Responses smaller than this go out uncompressed
+COMPRESS_MIN_SIZE = int(os.environ.get('POSTIBLE_COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.environ.get('POSTIBLE_COMPRESS_LEVEL', 6))
+COMPRESSIBLE_TYPES = {'application/json', 'application/x-ndjson', 'application/javascript',
+                      'text/javascript', 'text/html', 'text/css', 'text/plain'}
+# A versioned static URL always serves the same bytes, so browsers may
+# keep it for a year without revalidating
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+def response_encoding():
+    """The best encoding the client accepts: br if brotli is installed, else gzip"""
+    return request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+
+def compress(data, encoding, best=False):
+    """Compress a whole body; `best` trades speed for size, for static files
+    compressed only once"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else 5)
+    return gzip.compress(data, 9 if best else COMPRESS_LEVEL, mtime=0)
+
+def compress_chunks(chunks, encoding):
+    """Compress a streamed body as it is produced"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        process, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process, finish = compressor.compress, compressor.flush
+    try:
+        for chunk in chunks:
+            data = process(chunk.encode() if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        # Ends stream_with_context's request context when the client
+        # disconnects early
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+@app.after_request
+def compress_response(response):
+    """Compress text responses for clients that accept it. Static files
+    are left to serve_static, which has precompressed copies."""
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = response_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    # Compressed bytes differ from the identity ones, so the ETag may only
+    # match weakly
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+_static_versions = {}
+
+def static_version(filename):
+    """Short content hash of a static file, recomputed when it changes"""
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _static_versions.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as f:
+        version = hashlib.sha1(f.read()).hexdigest()[:12]
+    _static_versions[filename] = (mtime, version)
+    return version
+
+@app.url_defaults
+def version_static_urls(endpoint, values):
+    """url_for('static', ...) adds the content hash, e.g. styles.css?v=3f2a.."""
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        version = static_version(values['filename'])
+        if version:
+            values['v'] = version
+
+def precompressed(filename, encoding):
+    """Name of the static file's .gz or .br copy, written next to it on
+    first use and rewritten when the file changes. None for small files
+    and when the copy can't be written."""
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path) or os.path.getsize(path) < COMPRESS_MIN_SIZE:
+        return None
+    suffix = '.br' if encoding == 'br' else '.gz'
+    target = path + suffix
+    try:
+        if not os.path.exists(target) or os.path.getmtime(target) < os.path.getmtime(path):
+            with open(path, 'rb') as f:
+                data = compress(f.read(), encoding, best=True)
+            tmp_path = f'{target}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, target)
+    except OSError as e:
+        print(f"Could not precompress {filename}: {e}")
+        return None
+    return filename + suffix
+
+def serve_static(filename):
+    """Replaces Flask's static view: serves the precompressed copy when
+    the client accepts it, and caches versioned URLs for good"""
+    mimetype = mimetypes.guess_type(filename)[0]
+    encoding = response_encoding() if mimetype in COMPRESSIBLE_TYPES else None
+    name = precompressed(filename, encoding) if encoding else None
+    if name:
+        response = send_from_directory(app.static_folder, name, mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_from_directory(app.static_folder, filename)
+    response.vary.add('Accept-Encoding')
+    version = request.args.get('v')
+    if version and version == static_version(filename):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+app.view_functions['static'] = serve_static
+
+# Statements slower than this are logged with their query plan; unset to disable
+SLOW_QUERY_MS = os.environ.get('POSTIBLE_SLOW_QUERY_MS')
+SLOW_QUERY_SECONDS = float(SLOW_QUERY_MS) / 1000 if SLOW_QUERY_MS else None
+slow_queries = deque(maxlen=50)
+
+def statement_label(sql):
+    """Normalize SQL into a metric label: one line, IN lists collapsed"""
+    sql = ' '.join(sql.split())
+    sql = re.sub(r'\(\?(?:, ?\?)+\)', '(?...)', sql)
+    return sql[:160]
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that records the time and row count of every statement.
+
+    Time spent in execute and in the fetch calls is added up per statement
+    and recorded once the statement is finished: when all its rows have
+    been fetched, or when the cursor runs the next statement or goes away.
+    """
+
+    _sql = None
+    _parameters = None
+    _elapsed = 0.0
+    _rows = 0
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._elapsed += time.perf_counter() - start
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        self._sql, self._parameters = sql, parameters
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        self._sql, self._parameters = sql, None
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(super().fetchmany, self.arraysize if size is None else size)
+        self._rows += len(rows)
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+    def _finish(self):
+        if self._sql is None:
+            return
+        sql, parameters, elapsed = self._sql, self._parameters, self._elapsed
+        rows = self._rows if self.description else max(self.rowcount, 0)
+        self._sql, self._parameters, self._elapsed, self._rows = None, None, 0.0, 0
+
+        label = (('statement', statement_label(sql)),)
+        metrics.observe('postible_sql_duration_seconds', elapsed, label)
+        metrics.inc('postible_sql_rows_total', label, rows)
+        if SLOW_QUERY_SECONDS is not None and elapsed >= SLOW_QUERY_SECONDS:
+            log_slow_query(self.connection, sql, parameters, elapsed, label)
+
+def log_slow_query(conn, sql, parameters, elapsed, label):
+    """Record a slow statement together with its EXPLAIN QUERY PLAN"""
+    metrics.inc('postible_slow_queries_total', label)
+    plan = None
+    if parameters is not None:
+        try:
+            plan_cursor = conn.cursor(sqlite3.Cursor)
+            plan_cursor.execute(f'EXPLAIN QUERY PLAN {sql}', parameters)
+            plan = [row[3] for row in plan_cursor.fetchall()]
+        except sqlite3.Error:
+            pass
+    slow_queries.append({
+        'statement': label[0][1],
+        'ms': round(elapsed * 1000, 2),
+        'plan': plan
+    })
+    print(f"Slow query ({elapsed * 1000:.1f} ms): {label[0][1]} plan={plan}")
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors, including those of execute(), are instrumented"""
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or InstrumentedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+DB_PATH = 'db/users.db'
+# Posts moved out of the hot tables by archive_old_posts
+ARCHIVE_PATH = 'db/archive.db'
+CHANGE_LOG_RETENTION = 10000
+# Idle connections kept open for reuse; more are opened on demand
+DB_POOL_SIZE = int(os.environ.get('POSTIBLE_DB_POOL_SIZE', 8))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('POSTIBLE_DB_BUSY_TIMEOUT_MS', 5000))
+# Idle read-only connections kept for the feed routes, one per CPU by default
+DB_READ_POOL_SIZE = int(os.environ.get('POSTIBLE_DB_READ_POOL_SIZE', os.cpu_count() or 4))
+
+class ConnectionPool:
+    """Reusable SQLite connections, configured once when opened.
+
+    acquire() never blocks: it hands out an idle connection or opens a new
+    one, so it is safe to call from eventlet green threads as well as from
+    OS threads. Each connection keeps its own prepared-statement cache,
+    which is what makes reuse worthwhile beyond the connect cost.
+
+    A read_only pool opens both databases with mode=ro and query_only, so
+    its connections can never take the write lock.
+    """
+
+    def __init__(self, path, size, archive_path=None, read_only=False):
+        self.path = path
+        self.size = size
+        self.archive_path = archive_path
+        self.read_only = read_only
+        self._idle = deque()
+        self._lock = Lock()
+
+    def _connect(self):
+        if self.read_only:
+            return self._connect_read_only()
+        conn = sqlite3.connect(self.path, check_same_thread=False,
+                               cached_statements=256, factory=InstrumentedConnection)
+        # Only takes effect on a new database file, so it has to come first
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA mmap_size = 268435456')
+        conn.execute('PRAGMA cache_size = -16000')
+        if self.archive_path:
+            conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+            conn.execute('PRAGMA archive.journal_mode = WAL')
+            conn.execute('PRAGMA archive.synchronous = NORMAL')
+        return conn
+
+    def _connect_read_only(self):
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False,
+                               cached_statements=256, factory=InstrumentedConnection)
+        conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA mmap_size = 268435456')
+        conn.execute('PRAGMA cache_size = -16000')
+        if self.archive_path:
+            conn.execute('ATTACH DATABASE ? AS archive', (f'file:{self.archive_path}?mode=ro',))
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def release(self, conn):
+        # Never hand out a connection with a transaction left open
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with-block."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+db_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE, ARCHIVE_PATH)
+read_pool = ConnectionPool(DB_PATH, DB_READ_POOL_SIZE, ARCHIVE_PATH, read_only=True)
+
+# Seconds between in-memory snapshots of the hot database for the feeds;
+# unset to read the feeds from the file
+READ_SNAPSHOT_INTERVAL = os.environ.get('POSTIBLE_READ_SNAPSHOT_INTERVAL')
+
+class ReadSnapshot:
+    """In-memory copy of the hot database, taken with the SQLite backup API.
+
+    Archiving keeps db/users.db down to the hot window, so the copy stays
+    small; the archive is attached read-only from its file. A refresher
+    thread replaces the copy every `interval` seconds with a new one, and
+    requests still reading the old copy finish on it. Reads from the
+    snapshot lag writes by up to `interval`.
+    """
+
+    def __init__(self, path, interval, archive_path=None):
+        self.path = path
+        self.interval = interval
+        self.archive_path = archive_path
+        # (connection, feed cache version when the copy was started)
+        self._current = None
+        self._thread = None
+        self.refreshes = 0
+        self.failures = 0
+        self.last_duration = None
+        self.taken_at = None
+
+    def refresh(self):
+        start = time.monotonic()
+        cache_version = feed_cache.version
+        source = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        try:
+            snapshot = sqlite3.connect(':memory:', check_same_thread=False, cached_statements=256,
+                                       factory=InstrumentedConnection)
+            source.backup(snapshot)
+        finally:
+            source.close()
+        if self.archive_path:
+            snapshot.execute('ATTACH DATABASE ? AS archive', (f'file:{self.archive_path}?mode=ro',))
+        snapshot.execute('PRAGMA query_only = ON')
+        self._current = (snapshot, cache_version)
+        self.taken_at = time.monotonic()
+        self.refreshes += 1
+        self.last_duration = round(self.taken_at - start, 3)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except sqlite3.Error as e:
+                self.failures += 1
+                print(f"Error taking the read snapshot: {e}")
+            time.sleep(self.interval)
+
+    def current(self):
+        """The latest snapshot and the feed cache version it is at least as
+        new as, or None before the first one is taken"""
+        return self._current
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'last_duration': self.last_duration,
+            'age': None if self.taken_at is None else round(time.monotonic() - self.taken_at, 3)
+        }
+
+read_snapshot = (ReadSnapshot(DB_PATH, float(READ_SNAPSHOT_INTERVAL), ARCHIVE_PATH)
+                 if READ_SNAPSHOT_INTERVAL else None)
+
+def get_db():
+    """Return the connection of the current app context, borrowing one on first use."""
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+def get_read_db():
+    """Return a read-only connection for the current app context, for
+    routes that never write, so long scans don't hold up the writers."""
+    if 'read_db' not in g:
+        g.read_db = read_pool.acquire()
+    return g.read_db
+
+def get_feed_db():
+    """Like get_read_db, but reading from the in-memory snapshot when one
+    is kept; only for feeds, which may lag writes by a few seconds.
+
+    Sets g.feed_version to the feed cache version the data is current for.
+    """
+    current = read_snapshot.current() if read_snapshot else None
+    if current:
+        conn, g.feed_version = current
+        return conn
+    g.feed_version = feed_cache.version
+    return get_read_db()
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+    conn = g.pop('read_db', None)
+    if conn is not None:
+        read_pool.release(conn)
+
+MIGRATE_LOCK_PATH = 'db/migrate.lock'
+
+# Set once init_db() has brought the schema up to date; /ready waits for it
+db_ready = Event()
+
 def init_db():
-    conn = sqlite3.connect('db/users.db')
-    c = conn.cursor()
+    with db_pool.connection() as conn:
+        migrate(conn)
+    db_ready.set()
+
+# Schema migrations, each run in its own transaction by migrate(). The
+# early ones only use IF NOT EXISTS, so databases created before versioning
+# pass through them unchanged and are simply stamped.
+
+def migration_initial_tables(c):
+    """Users, posts and likes"""
     # Users table
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -58,11 +698,1239 @@ def init_db():
             FOREIGN KEY (post_id) REFERENCES posts (id)
         )
     ''')
-    conn.commit()
-    conn.close()
+
+def migration_feed_indexes(c):
+    """Indexes the keyset-paginated feeds walk instead of sorting"""
+    c.execute('CREATE INDEX IF NOT EXISTS idx_posts_created ON posts (created_at, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_posts_user_created ON posts (user_id, created_at, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_likes_post ON likes (post_id, user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_likes_user_created ON likes (user_id, created_at, post_id)')
+
+def migration_like_counts(c):
+    """Denormalized posts.like_count, maintained by triggers on likes"""
+    c.execute('PRAGMA table_info(posts)')
+    if 'like_count' not in [column[1] for column in c.fetchall()]:
+        c.execute('ALTER TABLE posts ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0')
+        c.execute('''
+            UPDATE posts
+            SET like_count = (SELECT COUNT(*) FROM likes WHERE likes.post_id = posts.id)
+        ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS likes_count_insert AFTER INSERT ON likes
+        BEGIN
+            UPDATE posts SET like_count = like_count + 1 WHERE id = NEW.post_id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS likes_count_delete AFTER DELETE ON likes
+        BEGIN
+            UPDATE posts SET like_count = like_count - 1 WHERE id = OLD.post_id;
+        END
+    ''')
+
+def migration_post_search(c):
+    """Full-text index over post content, kept in sync by triggers"""
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'posts_fts'")
+    fts_exists = c.fetchone() is not None
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+            content,
+            content='posts',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts
+        BEGIN
+            INSERT INTO posts_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts
+        BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF content ON posts
+        BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+            INSERT INTO posts_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END
+    ''')
+    if not fts_exists:
+        # One-time backfill of the posts written before the index existed
+        c.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+
+def migration_change_log(c):
+    """Log of new posts and like count changes, read by reconnecting clients"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            post_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS changes_post_insert AFTER INSERT ON posts
+        BEGIN
+            INSERT INTO changes (kind, post_id) VALUES ('post', NEW.id);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS changes_like_count AFTER UPDATE OF like_count ON posts
+        BEGIN
+            INSERT INTO changes (kind, post_id) VALUES ('likes', NEW.id);
+        END
+    ''')
+    # Keep only the most recent CHANGE_LOG_RETENTION entries; older cursors
+    # are told to reload instead
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS changes_prune AFTER INSERT ON changes
+        WHEN NEW.seq % 1000 = 0
+        BEGIN
+            DELETE FROM changes WHERE seq <= NEW.seq - {CHANGE_LOG_RETENTION};
+        END
+    ''')
+
+def migration_archive(c):
+    """Tables of the archive database, attached to every connection"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS archive.posts (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP,
+            like_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS archive.likes (
+            user_id INTEGER NOT NULL,
+            post_id INTEGER NOT NULL,
+            created_at TIMESTAMP,
+            PRIMARY KEY (user_id, post_id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS archive.idx_posts_created ON posts (created_at, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS archive.idx_posts_user_created ON posts (user_id, created_at, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS archive.idx_likes_user_created ON likes (user_id, created_at, post_id)')
+
+def migration_follows_timeline(c):
+    """Follow graph and the materialized home timelines"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS follows (
+            follower_id INTEGER NOT NULL,
+            followee_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (follower_id, followee_id)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_follows_followee ON follows (followee_id, follower_id)')
+    # One row per post per follower, written when the post is; the primary
+    # key is the order a timeline is read in
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS timeline (
+            user_id INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            post_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, created_at, post_id)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_timeline_post ON timeline (post_id)')
+    # Nobody follows anyone yet, but each timeline starts with the user's
+    # own posts, as the post writer would have put them there
+    c.execute('''
+        INSERT OR IGNORE INTO timeline (user_id, created_at, post_id)
+        SELECT user_id, created_at, id FROM posts
+    ''')
+
+    c.execute('PRAGMA table_info(users)')
+    if 'follower_count' not in [column[1] for column in c.fetchall()]:
+        c.execute('ALTER TABLE users ADD COLUMN follower_count INTEGER NOT NULL DEFAULT 0')
+        # Set once an account outgrows fan-out on write, and never cleared,
+        # so none of its posts can fall between the two timeline paths
+        c.execute('ALTER TABLE users ADD COLUMN fanout_on_read INTEGER NOT NULL DEFAULT 0')
+    # The bots post all day; nobody's timeline should be filled with copies
+    c.execute(f'''
+        UPDATE users SET fanout_on_read = 1
+        WHERE username IN ({', '.join(['?'] * len(SEED_USERNAMES))})
+    ''', SEED_USERNAMES)
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS follows_count_insert AFTER INSERT ON follows
+        BEGIN
+            UPDATE users SET follower_count = follower_count + 1 WHERE id = NEW.followee_id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS follows_count_delete AFTER DELETE ON follows
+        BEGIN
+            UPDATE users SET follower_count = follower_count - 1 WHERE id = OLD.followee_id;
+        END
+    ''')
+
+def migration_content_dedupe(c):
+    """Normalized content hashes of posts and MinHash bands of bot posts.
+
+    Existing posts keep a NULL hash until dedupe_posts() gets to them.
+    """
+    c.execute('PRAGMA table_info(posts)')
+    if 'content_hash' not in [column[1] for column in c.fetchall()]:
+        c.execute('ALTER TABLE posts ADD COLUMN content_hash TEXT')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_posts_content_hash ON posts (content_hash)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS content_bands (
+            band INTEGER NOT NULL,
+            post_id INTEGER NOT NULL,
+            PRIMARY KEY (band, post_id)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_content_bands_post ON content_bands (post_id)')
+
+# Applied in order, a migration's version being its position in the list.
+# Only ever append: applied migrations must not be edited or reordered.
+MIGRATIONS = [
+    migration_initial_tables,
+    migration_feed_indexes,
+    migration_like_counts,
+    migration_post_search,
+    migration_change_log,
+    migration_archive,
+    migration_follows_timeline,
+    migration_content_dedupe
+]
+
+def schema_version(c):
+    c.execute('SELECT MAX(version) FROM schema_migrations')
+    return c.fetchone()[0] or 0
+
+def migrate(conn):
+    """Bring the database up to the latest version in MIGRATIONS.
+
+    Workers starting together take turns on MIGRATE_LOCK_PATH, so every
+    migration runs once; each one commits together with its
+    schema_migrations row, so a failed migration is retried on the next
+    start.
+    """
+    with open(MIGRATE_LOCK_PATH, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        c = conn.cursor()
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.commit()
+
+        current = schema_version(c)
+        if current > len(MIGRATIONS):
+            print(f"Database schema version {current} is newer than this code "
+                  f"({len(MIGRATIONS)})")
+        for version, migration in enumerate(MIGRATIONS[current:], current + 1):
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                migration(c)
+                c.execute('INSERT INTO schema_migrations (version, name) VALUES (?, ?)',
+                          (version, migration.__name__))
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            print(f"Applied migration {version}: {migration.__name__}")
+        enable_incremental_vacuum(conn)
+
+def enable_incremental_vacuum(conn):
+    """Switch a database created before archiving to incremental
+    auto-vacuum. That takes one full VACUUM, which holds the write lock for
+    the whole file, so it runs here at startup before the port opens
+    rather than in the archive job."""
+    c = conn.cursor()
+    c.execute('PRAGMA auto_vacuum')
+    if c.fetchone()[0] != 2:
+        print("Switching the database to incremental auto-vacuum")
+        start = time.monotonic()
+        c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        c.execute('VACUUM')
+        print(f"Vacuumed the database in {time.monotonic() - start:.1f}s")
+
+# scrypt cost parameters; raising SCRYPT_N makes every hash slower and
+# stored hashes with other parameters are upgraded at the next signin
+SCRYPT_N = int(os.environ.get('POSTIBLE_SCRYPT_N', 2**14))
+SCRYPT_R = 8
+SCRYPT_P = 1
+# Passwords hashed at once; each scrypt call uses 128 * N * r bytes
+PASSWORD_HASH_WORKERS = int(os.environ.get('POSTIBLE_PASSWORD_HASH_WORKERS', 4))
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r, dklen=32)
+
+def current_change_seq(c):
+    """Sequence number of the latest change log entry, 0 if there is none"""
+    c.execute('SELECT MAX(seq) FROM changes')
+    return c.fetchone()[0] or 0
 
 def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Salted scrypt hash, stored as scrypt$n$r$p$salt$hash"""
+    salt = os.urandom(16)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return '$'.join(['scrypt', str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P),
+                     base64.b64encode(salt).decode(), base64.b64encode(digest).decode()])
+
+# Checked against when the username is unknown, so that a failed signin
+# takes as long whether or not the account exists
+DUMMY_PASSWORD_HASH = '$'.join(['scrypt', str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P),
+                                base64.b64encode(bytes(16)).decode(),
+                                base64.b64encode(bytes(32)).decode()])
+
+def verify_password(password, stored):
+    """Check a password against a stored hash.
+
+    Returns (matches, needs_rehash). Legacy unsalted SHA-256 hashes and
+    scrypt hashes with outdated cost parameters need a rehash.
+    """
+    if not stored.startswith('scrypt$'):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored), True
+    _, n, r, p, salt, digest = stored.split('$')
+    n, r, p = int(n), int(r), int(p)
+    expected = base64.b64decode(digest)
+    matches = hmac.compare_digest(_scrypt(password, base64.b64decode(salt), n, r, p), expected)
+    return matches, (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS,
+                                       thread_name_prefix='password-hash')
+_green_hash_slots = None
+
+def in_green_thread():
+    """Whether the caller runs on the eventlet hub rather than in an OS
+    thread of its own, such as a scheduler worker"""
+    return socketio.async_mode == 'eventlet' and (
+        bool(MESSAGE_QUEUE) or current_thread() is main_thread())
+
+def run_in_hash_pool(fn, *args):
+    """Run a password hashing function without blocking the event loop.
+
+    From green threads the work goes to eventlet's native thread pool,
+    which lets other green threads run meanwhile, with at most
+    PASSWORD_HASH_WORKERS hashes in flight; otherwise it runs in a bounded
+    thread pool.
+    """
+    global _green_hash_slots
+    if in_green_thread():
+        from eventlet import tpool
+        from eventlet.semaphore import Semaphore
+        if _green_hash_slots is None:
+            _green_hash_slots = Semaphore(PASSWORD_HASH_WORKERS)
+        with _green_hash_slots:
+            return tpool.execute(fn, *args)
+    return password_executor.submit(fn, *args).result()
+
+# Users kept in the id <-> username cache, and how long an entry is trusted;
+# the TTL bounds how stale a change made by another worker can look here
+USER_CACHE_SIZE = int(os.environ.get('POSTIBLE_USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.environ.get('POSTIBLE_USER_CACHE_TTL', 60))
+
+class UserCache:
+    """In-process LRU cache of user id <-> username with a TTL.
+
+    Feed rows carry only the author id; usernames() fills them in, fetching
+    every missing one with a single query. Lookups by username remember
+    unknown names too, so signup and renames must call invalidate(). A
+    version counter keeps lookups racing an invalidation from storing what
+    they read before it.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._by_id = OrderedDict()
+        self._by_name = OrderedDict()
+        self._lock = Lock()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _get(self, entries, key, now):
+        """Return (found, value) for a key, counting the lookup"""
+        entry = entries.get(key)
+        if entry is not None and entry[1] > now:
+            entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+        self.misses += 1
+        return False, None
+
+    def _put(self, entries, key, value, expires):
+        entries[key] = (value, expires)
+        entries.move_to_end(key)
+        while len(entries) > self.size:
+            entries.popitem(last=False)
+
+    def _store(self, users, unknown_names, version):
+        with self._lock:
+            if version != self._version:
+                return
+            expires = time.monotonic() + self.ttl
+            for user_id, username in users:
+                self._put(self._by_id, user_id, username, expires)
+                self._put(self._by_name, username, user_id, expires)
+            for username in unknown_names:
+                self._put(self._by_name, username, None, expires)
+
+    def add(self, user_id, username):
+        """Remember a user just read from the database, e.g. at login"""
+        self._store([(user_id, username)], (), self._version)
+
+    def usernames(self, c, user_ids):
+        """Map each of user_ids to its username, or None if there is no such user"""
+        now = time.monotonic()
+        names, missing = {}, []
+        with self._lock:
+            version = self._version
+            for user_id in set(user_ids):
+                found, username = self._get(self._by_id, user_id, now)
+                if found:
+                    names[user_id] = username
+                else:
+                    missing.append(user_id)
+        if missing:
+            c.execute(f'SELECT id, username FROM users WHERE id IN ({",".join("?" * len(missing))})',
+                      missing)
+            users = c.fetchall()
+            self._store(users, (), version)
+            names.update(users)
+        return names
+
+    def user_id(self, c, username):
+        """Id of the user with the given username, or None"""
+        with self._lock:
+            version = self._version
+            found, user_id = self._get(self._by_name, username, time.monotonic())
+        if found:
+            return user_id
+        c.execute('SELECT id FROM users WHERE username = ?', (username,))
+        row = c.fetchone()
+        if row:
+            self._store([(row[0], username)], (), version)
+            return row[0]
+        self._store((), (username,), version)
+        return None
+
+    def invalidate(self, user_id=None, username=None):
+        """Forget a user after signup or a rename; pass the old username of a rename"""
+        with self._lock:
+            self._version += 1
+            self.invalidations += 1
+            if user_id is not None:
+                entry = self._by_id.pop(user_id, None)
+                if entry is not None:
+                    self._by_name.pop(entry[0], None)
+            if username is not None:
+                entry = self._by_name.pop(username, None)
+                if entry is not None and entry[0] is not None:
+                    self._by_id.pop(entry[0], None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._by_id),
+                'names': len(self._by_name),
+                'capacity': self.size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'invalidations': self.invalidations
+            }
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def with_usernames(c, rows):
+    """Fill in the username of feed rows, which the feed queries leave NULL
+    so they don't join users, from the user cache"""
+    names = user_cache.usernames(c, [row[4] for row in rows])
+    return [(*row[:3], names.get(row[4]), *row[4:]) for row in rows]
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Cursor that sorts after every post, used for the first page so the
+# keyset condition stays a plain index range
+FIRST_PAGE_CURSOR = ('9999-12-31 23:59:59', 2**63 - 1)
+
+# The feed queries, each a keyset walk down one index; benchmark.py checks
+# their plans against the seeded database. They leave the username NULL for
+# with_usernames() to fill in from the user cache
+
+# Global feed, walking posts(created_at, id)
+FEED_SQL = '''
+    SELECT 
+        p.id,
+        p.content,
+        p.created_at,
+        NULL AS username,
+        p.user_id AS author_id,
+        p.like_count,
+        p.created_at,
+        0 AS archived
+    FROM posts p
+    WHERE (p.created_at, p.id) < (?, ?)
+    ORDER BY p.created_at DESC, p.id DESC
+    LIMIT ?
+'''
+
+# Posts created by one user, walking posts(user_id, created_at, id)
+MY_FEED_SQL = '''
+    SELECT 
+        p.id,
+        p.content,
+        p.created_at,
+        NULL AS username,
+        p.user_id AS author_id,
+        p.like_count,
+        p.created_at,
+        0 AS archived
+    FROM posts p
+    WHERE p.user_id = ?
+      AND (p.created_at, p.id) < (?, ?)
+    ORDER BY p.created_at DESC, p.id DESC
+    LIMIT ?
+'''
+
+# Posts liked by one user, most recently liked first, walking
+# likes(user_id, created_at, post_id) so the cost does not depend on the
+# size of the tables
+LIKED_FEED_SQL = '''
+    SELECT 
+        p.id,
+        p.content,
+        p.created_at,
+        NULL AS username,
+        p.user_id AS author_id,
+        p.like_count,
+        l.created_at as liked_at,
+        0 AS archived
+    FROM likes l
+    JOIN posts p ON p.id = l.post_id
+    WHERE l.user_id = ?
+      AND (l.created_at, l.post_id) < (?, ?)
+    ORDER BY l.created_at DESC, l.post_id DESC
+    LIMIT ?
+'''
+
+# Home timeline of one user, walking the timeline primary key
+TIMELINE_SQL = '''
+    SELECT 
+        p.id,
+        p.content,
+        p.created_at,
+        NULL AS username,
+        p.user_id AS author_id,
+        p.like_count,
+        t.created_at,
+        0 AS archived
+    FROM timeline t
+    JOIN posts p ON p.id = t.post_id
+    WHERE t.user_id = ?
+      AND (t.created_at, t.post_id) < (?, ?)
+    ORDER BY t.created_at DESC, t.post_id DESC
+    LIMIT ?
+'''
+
+# Followed accounts whose posts are not fanned out on write
+FANOUT_ON_READ_SQL = '''
+    SELECT f.followee_id
+    FROM follows f
+    JOIN users u ON u.id = f.followee_id
+    WHERE f.follower_id = ? AND u.fanout_on_read
+'''
+
+def archive_query(sql):
+    """The same feed query over the archive tables, flagging its rows"""
+    return (sql.replace('FROM posts p', 'FROM archive.posts p')
+               .replace('FROM likes l', 'FROM archive.likes l')
+               .replace('JOIN posts p', 'JOIN archive.posts p')
+               .replace('0 AS archived', '1 AS archived'))
+
+# For each feed view: the query over the hot tables, the same query over
+# the archive, and the key of the newest archived row the view can show
+FEED_QUERIES = {
+    'all': (FEED_SQL,
+            archive_query(FEED_SQL),
+            '''SELECT created_at, id FROM archive.posts
+               ORDER BY created_at DESC, id DESC LIMIT 1'''),
+    'my': (MY_FEED_SQL,
+           archive_query(MY_FEED_SQL),
+           '''SELECT created_at, id FROM archive.posts WHERE user_id = ?
+              ORDER BY created_at DESC, id DESC LIMIT 1'''),
+    'liked': (LIKED_FEED_SQL,
+              archive_query(LIKED_FEED_SQL),
+              '''SELECT created_at, post_id FROM archive.likes WHERE user_id = ?
+                 ORDER BY created_at DESC, post_id DESC LIMIT 1''')
+}
+
+def feed_rows(c, view, user_id, cursor, limit):
+    """Fetch `limit + 1` rows of a feed view before `cursor`.
+
+    The hot tables answer alone while the page stays newer than anything
+    archived for the view, which takes one index lookup in the archive to
+    tell; past that, the page is merged from both databases.
+    """
+    hot_sql, archive_sql, newest_sql = FEED_QUERIES[view]
+    user_params = () if view == 'all' else (user_id,)
+    c.execute(hot_sql, (*user_params, *cursor, limit + 1))
+    rows = c.fetchall()
+
+    c.execute(newest_sql, user_params)
+    newest = c.fetchone()
+    if newest is None or (len(rows) > limit and (rows[-1][6], rows[-1][0]) > tuple(newest)):
+        return with_usernames(c, rows)
+
+    c.execute(archive_sql, (*user_params, *cursor, limit + 1))
+    rows += c.fetchall()
+    rows.sort(key=lambda row: (row[6], row[0]), reverse=True)
+    return with_usernames(c, rows[:limit + 1])
+
+# Accounts with more followers than this have their posts read into
+# timelines at query time instead of copied to every follower on write
+FANOUT_FOLLOWER_LIMIT = int(os.environ.get('POSTIBLE_FANOUT_FOLLOWER_LIMIT', 1000))
+# Recent posts of a newly followed account copied into the follower's timeline
+TIMELINE_BACKFILL = 100
+
+def timeline_rows(c, user_id, cursor, limit):
+    """Fetch `limit + 1` rows of a user's home timeline before `cursor`.
+
+    The materialized timeline answers with one range scan; each followed
+    fan-out-on-read account adds one scan of its own posts, merged in. Posts
+    of an account from before it switched to fan-out on read are in both,
+    so rows are deduplicated by id. Archived posts are not on timelines.
+    """
+    c.execute(TIMELINE_SQL, (user_id, *cursor, limit + 1))
+    rows = c.fetchall()
+    c.execute(FANOUT_ON_READ_SQL, (user_id,))
+    for (followee_id,) in c.fetchall():
+        c.execute(MY_FEED_SQL, (followee_id, *cursor, limit + 1))
+        rows += c.fetchall()
+    rows = list({row[0]: row for row in rows}.values())
+    rows.sort(key=lambda row: (row[6], row[0]), reverse=True)
+    return with_usernames(c, rows[:limit + 1])
+
+def parse_page_args():
+    """Read the `before` cursor and `limit` query args of a feed request.
+
+    The cursor has the form `<created_at>,<id>` and is returned as a tuple;
+    the first page gets FIRST_PAGE_CURSOR. Raises ValueError on malformed input.
+    """
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    if limit < 1:
+        raise ValueError('limit must be a positive integer')
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    before = request.args.get('before')
+    if not before:
+        return FIRST_PAGE_CURSOR, limit
+    created_at, sep, post_id = before.rpartition(',')
+    if not sep or not created_at or not post_id.isdigit():
+        raise ValueError('before must have the form <created_at>,<id>')
+    return (created_at, int(post_id)), limit
+
+def liked_post_ids(c, user_id, post_ids, archived_ids=()):
+    """Return the subset of post_ids liked by user_id.
+
+    One lookup on the likes primary key (user_id, post_id) per post, so the
+    cost depends only on the page size. Likes of the posts in archived_ids
+    are looked up in the archive instead.
+    """
+    liked = set()
+    archived_ids = set(archived_ids)
+    for table, ids in (('likes', [i for i in post_ids if i not in archived_ids]),
+                       ('archive.likes', list(archived_ids))):
+        if not ids:
+            continue
+        placeholders = ','.join('?' * len(ids))
+        c.execute(f'''
+            SELECT post_id FROM {table}
+            WHERE user_id = ? AND post_id IN ({placeholders})
+        ''', (user_id, *ids))
+        liked.update(row[0] for row in c.fetchall())
+    return liked
+
+def post_page(rows, user_id, limit, liked_ids):
+    """Build a feed page from rows fetched with `limit + 1` as the LIMIT.
+
+    Rows are (id, content, created_at, username, author_id, like_count,
+    cursor_key), followed by the archived flag for the feed queries; the
+    extra row only tells us whether another page exists.
+    """
+    posts = []
+    for row in rows[:limit]:
+        posts.append({
+            'id': row[0],
+            'content': row[1],
+            'created_at': row[2],
+            'username': row[3],
+            'isAuthor': row[4] == user_id,
+            'likes': row[5],
+            'liked': row[0] in liked_ids
+        })
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = f'{last[6]},{last[0]}'
+    return {'posts': posts, 'next_cursor': next_cursor}
+
+def compact_json(value):
+    """JSON without the spaces json.dumps puts after separators"""
+    return json.dumps(value, separators=(',', ':'))
+
+# Rows pulled from SQLite per fetchmany call when streaming a response
+STREAM_BATCH_SIZE = int(os.environ.get('POSTIBLE_STREAM_BATCH_SIZE', 500))
+
+def iter_row_batches(c, size=STREAM_BATCH_SIZE):
+    """Yield the rows of an executed cursor in fetchmany batches"""
+    while True:
+        try:
+            rows = c.fetchmany(size)
+        except sqlite3.Error as e:
+            # The status line has already been sent, so all we can do is
+            # cut the body short
+            print(f"Error streaming rows: {str(e)}")
+            return
+        if not rows:
+            return
+        yield rows
+
+def stream_response(chunks, mimetype='application/json', **kwargs):
+    """Send a generator as the response body.
+
+    The request context, and with it the pooled connection in g.db, stays
+    open until the generator is exhausted.
+    """
+    return app.response_class(stream_with_context(chunks), mimetype=mimetype, **kwargs)
+
+FEED_CACHE_SIZE = int(os.environ.get('POSTIBLE_FEED_CACHE_SIZE', 64))
+# Upper bound on staleness when another worker wrote the change
+FEED_CACHE_TTL = float(os.environ.get('POSTIBLE_FEED_CACHE_TTL', 10))
+
+class FeedPage:
+    """The viewer-independent part of one global feed page.
+
+    Each post is serialized to JSON once; rendering for a viewer only
+    splices the isAuthor and liked flags into the stored fragments. The tag
+    is a hash of the content, so a page re-read after writes made by other
+    workers, or read from an outdated snapshot, never passes for another.
+    """
+
+    def __init__(self, rows, limit):
+        page = post_page(rows, None, limit, set())
+        self.next_cursor = page['next_cursor']
+        self.post_ids = [row[0] for row in rows[:limit]]
+        self.author_ids = [row[4] for row in rows[:limit]]
+        self.archived_ids = [row[0] for row in rows[:limit] if row[7]]
+        self.posts = []
+        for post in page['posts']:
+            del post['isAuthor'], post['liked']
+            self.posts.append(post)
+        self.fragments = [compact_json(post) for post in self.posts]
+        self._retag()
+        self.expires = time.monotonic() + FEED_CACHE_TTL
+
+    def _retag(self):
+        digest = hashlib.blake2b(compact_json(self.next_cursor).encode(), digest_size=8)
+        for fragment in self.fragments:
+            digest.update(fragment.encode())
+        self.tag = digest.hexdigest()
+
+    def set_likes(self, post_id, likes):
+        index = self.post_ids.index(post_id)
+        self.posts[index]['likes'] = likes
+        self.fragments[index] = compact_json(self.posts[index])
+        self._retag()
+
+    def etag(self, user_id, liked_ids):
+        # Counts can end up unchanged while the viewer's own likes differ,
+        # e.g. when they like a post someone else unlikes
+        liked = ','.join(str(post_id) for post_id in sorted(liked_ids))
+        digest = hashlib.blake2b(liked.encode(), digest_size=4).hexdigest()
+        return f'{self.tag}-{user_id}-{digest}'
+
+    def render(self, user_id, liked_ids):
+        posts = ','.join(
+            f'{fragment[:-1]},"isAuthor":{compact_json(author_id == user_id)},'
+            f'"liked":{compact_json(post_id in liked_ids)}}}'
+            for fragment, post_id, author_id
+            in zip(self.fragments, self.post_ids, self.author_ids))
+        return f'{{"posts":[{posts}],"next_cursor":{compact_json(self.next_cursor)}}}'
+
+class FeedCache:
+    """LRU cache of global feed pages, keyed by (cursor, limit).
+
+    Writes keep it current: a new post drops the cached first pages, which
+    are the only ones it can appear on, and a like change patches the count
+    in place. Cached pages also expire after FEED_CACHE_TTL so changes made
+    by other workers show up eventually.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._pages = OrderedDict()
+        self._lock = Lock()
+        # Bumped on every write so pages queried before it are not stored
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.invalidations = 0
+        self.patches = 0
+
+    @property
+    def version(self):
+        return self._version
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None and page.expires > time.monotonic():
+                self._pages.move_to_end(key)
+                self.hits += 1
+                return page
+            self.misses += 1
+            return None
+
+    def put(self, key, rows, limit, version):
+        """Cache a page queried when the cache was at `version`"""
+        with self._lock:
+            page = FeedPage(rows, limit)
+            if version == self._version:
+                self._pages[key] = page
+                self._pages.move_to_end(key)
+                while len(self._pages) > self.size:
+                    self._pages.popitem(last=False)
+            return page
+
+    def post_added(self):
+        with self._lock:
+            self._version += 1
+            for key in [key for key in self._pages if key[0] == FIRST_PAGE_CURSOR]:
+                del self._pages[key]
+                self.invalidations += 1
+
+    def likes_changed(self, post_id, likes):
+        with self._lock:
+            self._version += 1
+            for page in self._pages.values():
+                if post_id in page.post_ids:
+                    page.set_likes(post_id, likes)
+                    self.patches += 1
+
+    def count_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._pages),
+                'capacity': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'not_modified': self.not_modified,
+                'invalidations': self.invalidations,
+                'patches': self.patches
+            }
+
+feed_cache = FeedCache(FEED_CACHE_SIZE)
+
+# How long like updates and new posts are gathered before being sent
+EMIT_WINDOW = int(os.environ.get('POSTIBLE_EMIT_WINDOW_MS', 250)) / 1000
+# New posts kept while no flusher is running (i.e. nobody is connected yet)
+MAX_PENDING_POSTS = 100
+
+FEED_VIEWS = ('all', 'my', 'liked', 'timeline')
+
+def view_room(view, user_id):
+    """Socket.IO room of clients showing the given feed view"""
+    if view == 'my':
+        return f'view:my:{user_id}'
+    return f'view:{view}'
+
+def follower_room(author_id):
+    """Socket.IO room of the clients showing a timeline that follows the
+    author; timeline clients join one per followed account and their own"""
+    return f'followers:{author_id}'
+
+class EventBatcher:
+    """Coalesces socket.io broadcasts into one frame per room per window.
+
+    Like updates are coalesced per post so only the latest count is sent,
+    and dropped when the count ends the window where it started, as when a
+    like is toggled on and off. Only the broadcast collapses: each toggle
+    has already been written, with its change log row, by then. New posts
+    are batched into a single list.
+    Each frame goes only to the rooms of the feed views that show the event:
+
+    - new posts go to the global view, to the author's followers and to
+      the author's "my posts" view
+    - like updates go to the global and liked views, to the author's
+      followers and to the author's "my posts" view
+
+    Events can be queued from any thread; frames are sent by one flusher
+    task started through socketio, so it runs as a green thread under
+    eventlet.
+    """
+
+    def __init__(self, socketio, window):
+        self.socketio = socketio
+        self.window = window
+        self._posts = deque()
+        self._likes = {}
+        self._lock = Lock()
+        self._task = None
+        self.collapsed = 0
+
+    def post_created(self, post, author_id):
+        with self._lock:
+            self._posts.append((post, author_id))
+            if self._task is None and len(self._posts) > MAX_PENDING_POSTS:
+                self._posts.popleft()
+
+    def likes_changed(self, post_id, likes, previous, author_id, seq):
+        """Queue a like count change from `previous` to `likes`"""
+        with self._lock:
+            if post_id in self._likes:
+                previous = self._likes[post_id][1]
+            self._likes[post_id] = (likes, previous, author_id, seq)
+
+    def start(self):
+        with self._lock:
+            if self._task is not None:
+                return
+            self._task = True
+        self._task = self.socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.window)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error broadcasting events: {e}")
+
+    def flush(self):
+        """Send everything queued so far, one frame per event type and room"""
+        with self._lock:
+            posts, self._posts = list(self._posts), deque()
+            likes, self._likes = self._likes, {}
+
+        frames = {}
+        for post, author_id in posts:
+            for room in (view_room('all', None), follower_room(author_id),
+                         view_room('my', author_id)):
+                frames.setdefault(('new_post', room), []).append(post)
+        for post_id, (count, previous, author_id, seq) in likes.items():
+            if count == previous:
+                with self._lock:
+                    self.collapsed += 1
+                continue
+            update = {'post_id': post_id, 'likes': count, 'seq': seq}
+            for room in (view_room('all', None), view_room('liked', None),
+                         follower_room(author_id), view_room('my', author_id)):
+                frames.setdefault(('like_update', room), []).append(update)
+
+        for (event, room), payload in frames.items():
+            self.socketio.emit(event, payload, to=room)
+            metrics.inc('postible_socketio_emits_total', (('event', event),))
+            metrics.inc('postible_socketio_emit_bytes_total', (('event', event),),
+                        len(json.dumps(payload)))
+
+event_batcher = EventBatcher(socketio, EMIT_WINDOW)
+
+# How long the post writer waits for more inserts before committing
+POST_WRITE_WINDOW = float(os.environ.get('POSTIBLE_POST_WRITE_WINDOW_MS', 5)) / 1000
+# Rows per INSERT statement, well under SQLite's bound parameter limit
+POST_INSERT_CHUNK = 200
+MAX_BATCH_POSTS = 100
+
+def wait_for_event(event, timeout):
+    """Wait on a threading.Event without stalling the event loop.
+
+    Without monkey patching, green threads share the main OS thread, so a
+    plain wait there would block every other request; the wait is handed
+    to eventlet's native thread pool instead.
+    """
+    if in_green_thread() and not MESSAGE_QUEUE:
+        from eventlet import tpool
+        return tpool.execute(event.wait, timeout)
+    return event.wait(timeout)
+
+def fan_out(c, first_id, last_id):
+    """Copy the posts with ids first_id..last_id into their authors' own
+    timelines and those of their followers, unless the author is fanned
+    out on read"""
+    c.execute('''
+        INSERT OR IGNORE INTO timeline (user_id, created_at, post_id)
+        SELECT p.user_id, p.created_at, p.id
+        FROM posts p
+        WHERE p.id BETWEEN ? AND ?
+        UNION ALL
+        SELECT f.follower_id, p.created_at, p.id
+        FROM posts p
+        JOIN users u ON u.id = p.user_id
+        JOIN follows f ON f.followee_id = p.user_id
+        WHERE p.id BETWEEN ? AND ? AND NOT u.fanout_on_read
+    ''', (first_id, last_id, first_id, last_id))
+
+class PostWriter:
+    """Group commit for new posts.
+
+    Inserts submitted from any thread are gathered for POST_WRITE_WINDOW
+    and committed by one writer thread in a single transaction, so
+    concurrent writers share one fsync. Ids and timestamps come back
+    through RETURNING instead of a follow-up SELECT. The posts are fanned
+    out to the followers' timelines in the same transaction, and are then
+    handed to the feed cache and the event batcher once committed, which
+    broadcasts them together in one new_post frame.
+    """
+
+    def __init__(self, pool, window):
+        self.pool = pool
+        self.window = window
+        self._pending = []
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+        self.transactions = 0
+        self.posts = 0
+
+    def insert(self, posts, timeout=30):
+        """Insert (user_id, username, content) tuples and return the new posts.
+
+        Blocks until the batch holding them is committed; raises the error
+        that failed it, sqlite3.Error for database errors.
+        """
+        write = {'posts': posts, 'done': Event(), 'result': None, 'error': None}
+        with self._lock:
+            self._pending.append(write)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+        if not wait_for_event(write['done'], timeout):
+            raise sqlite3.OperationalError('Timed out waiting for the post writer')
+        if write['error']:
+            raise write['error']
+        return write['result']
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.window)
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._wakeup.clear()
+            if batch:
+                self._commit(batch)
+
+    def _commit(self, batch):
+        rows = [post for write in batch for post in write['posts']]
+        try:
+            with self.pool.connection() as conn:
+                c = conn.cursor()
+                inserted = []
+                for start in range(0, len(rows), POST_INSERT_CHUNK):
+                    chunk = rows[start:start + POST_INSERT_CHUNK]
+                    c.execute(f'''
+                        INSERT INTO posts (user_id, content, content_hash)
+                        VALUES {', '.join(['(?, ?, ?)'] * len(chunk))}
+                        RETURNING id, created_at
+                    ''', [value for user_id, _, content in chunk
+                          for value in (user_id, content, content_hash(content))])
+                    # RETURNING order is unspecified, but new rowids are
+                    # handed out in VALUES order
+                    inserted.extend(sorted(c.fetchall()))
+                fan_out(c, inserted[0][0], inserted[-1][0])
+                seq = current_change_seq(c)
+                conn.commit()
+        except Exception as e:
+            # Any error fails this batch only; the thread keeps serving writes
+            print(f"Error writing posts: {str(e)}")
+            for write in batch:
+                write['error'] = e
+                write['done'].set()
+            return
+
+        self.transactions += 1
+        self.posts += len(rows)
+        feed_cache.post_added()
+        new_posts = []
+        for (user_id, username, content), (post_id, created_at) in zip(rows, inserted):
+            post = {
+                'id': post_id,
+                'content': content,
+                'created_at': created_at,
+                'username': username,
+                'isAuthor': False,
+                'likes': 0,
+                'liked': False,
+                'seq': seq
+            }
+            event_batcher.post_created(post, user_id)
+            new_posts.append(post)
+
+        start = 0
+        for write in batch:
+            write['result'] = new_posts[start:start + len(write['posts'])]
+            start += len(write['posts'])
+            write['done'].set()
+
+    def stats(self):
+        with self._lock:
+            pending = sum(len(write['posts']) for write in self._pending)
+        return {
+            'transactions': self.transactions,
+            'posts': self.posts,
+            'pending': pending
+        }
+
+post_writer = PostWriter(db_pool, POST_WRITE_WINDOW)
+
+RATE_LIMITING = os.environ.get('POSTIBLE_RATE_LIMITING', '1') == '1'
+# Budgets per rule as [requests, seconds], tracked per user id and per
+# client IP; POSTIBLE_RATE_LIMITS takes JSON of the same shape to override
+# them, e.g. {"like": {"user": [30, 60]}}
+RATE_LIMITS = {
+    'signup': {'ip': [10, 3600]},
+    'signin': {'ip': [20, 60]},
+    'post': {'user': [30, 60], 'ip': [120, 60]},
+    'like': {'user': [120, 60], 'ip': [600, 60]},
+    'follow': {'user': [60, 60]}
+}
+for rule, budgets in json.loads(os.environ.get('POSTIBLE_RATE_LIMITS', '{}')).items():
+    RATE_LIMITS.setdefault(rule, {}).update(budgets)
+# Buckets kept before the least recently used are dropped
+RATE_LIMIT_KEYS = 100000
+
+class RateLimiter:
+    """Token buckets keyed by (rule, scope, key).
+
+    A bucket holds up to `requests` tokens and refills at requests/seconds
+    per second; each request takes one, or its cost. A request costing
+    more than the bucket holds goes through once it is full and leaves it
+    in debt, so the average rate stays within budget. State is per
+    process, so with several workers the budget applies to each of them.
+    """
+
+    def __init__(self, limits, max_keys):
+        self.limits = limits
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+        self.allowed = {rule: 0 for rule in limits}
+        self.limited = {rule: 0 for rule in limits}
+
+    def check(self, rule, keys, cost=1):
+        """Charge a request of `cost` tokens to rule's bucket for each
+        (scope, key) pair.
+
+        Returns 0 if it is allowed, otherwise the seconds to wait before
+        retrying. A refused request takes no tokens from any bucket.
+        """
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            retry_after = 0
+            for scope, key in keys:
+                budget = self.limits[rule].get(scope)
+                if key is None or not budget:
+                    continue
+                requests, seconds = budget
+                bucket_key = (rule, scope, key)
+                tokens, updated = self._buckets.get(bucket_key, (requests, now))
+                tokens = min(requests, tokens + (now - updated) * requests / seconds)
+                buckets.append((bucket_key, tokens))
+                needed = min(cost, requests)
+                if tokens < needed:
+                    retry_after = max(retry_after, (needed - tokens) * seconds / requests)
+
+            if retry_after:
+                self.limited[rule] += 1
+                return retry_after
+
+            for bucket_key, tokens in buckets:
+                self._buckets[bucket_key] = (tokens - cost, now)
+                self._buckets.move_to_end(bucket_key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            self.allowed[rule] += 1
+            return 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'buckets': len(self._buckets),
+                'allowed': dict(self.allowed),
+                'limited': dict(self.limited)
+            }
+
+rate_limiter = RateLimiter(RATE_LIMITS, RATE_LIMIT_KEYS)
+
+def rate_limited(rule, cost=None):
+    """Answer 429 with Retry-After once the caller's budget for rule is spent.
+
+    `cost` is a function returning the tokens the current request takes,
+    one if not given.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if RATE_LIMITING:
+                retry_after = rate_limiter.check(
+                    rule, (('user', session.get('user_id')), ('ip', request.remote_addr)),
+                    cost() if cost else 1)
+                if retry_after:
+                    return (jsonify({'error': 'Too many requests'}), 429,
+                            {'Retry-After': str(math.ceil(retry_after))})
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@socketio.on('connect')
+def handle_connect():
+    if 'user_id' not in session:
+        return False
+    event_batcher.start()
+    join_room(view_room('all', session['user_id']))
+
+@socketio.on('set_view')
+def handle_set_view(data):
+    """Move the client to the room of the feed view it now shows"""
+    view = (data or {}).get('view')
+    if 'user_id' not in session or view not in FEED_VIEWS:
+        return
+    for room in rooms():
+        if room.startswith(('view:', 'followers:')):
+            leave_room(room)
+    if view == 'timeline':
+        # Sent again by the client after following or unfollowing someone
+        with db_pool.connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT followee_id FROM follows WHERE follower_id = ?',
+                      (session['user_id'],))
+            followees = [row[0] for row in c.fetchall()]
+        for author_id in [session['user_id'], *followees]:
+            join_room(follower_room(author_id))
+        return
+    join_room(view_room(view, session['user_id']))
 
 @app.route('/')
 def index():
@@ -71,6 +1939,7 @@ def index():
     return render_template('index.html')
 
 @app.route('/signup', methods=['POST'])
+@rate_limited('signup')
 def signup():
     data = request.get_json()
     username = data.get('username')
@@ -80,7 +1949,7 @@ def signup():
         return jsonify({'error': 'Username and password are required'}), 400
 
     try:
-        conn = sqlite3.connect('db/users.db')
+        conn = get_db()
         c = conn.cursor()
         
         # Check if username already exists
@@ -89,17 +1958,17 @@ def signup():
             return jsonify({'error': 'Username already exists'}), 409
 
         # Hash password and insert new user
-        hashed_password = hash_password(password)
+        hashed_password = run_in_hash_pool(hash_password, password)
         c.execute('INSERT INTO users (username, password) VALUES (?, ?)',
                  (username, hashed_password))
         conn.commit()
+        # The name may be cached as unknown from an earlier lookup
+        user_cache.invalidate(username=username)
         
         return jsonify({'message': 'User registered successfully'}), 201
 
     except sqlite3.Error as e:
         return jsonify({'error': 'Database error occurred'}), 500
-    finally:
-        conn.close()
 
 @app.route('/posts/liked')
 def get_liked_posts():
@@ -107,47 +1976,25 @@ def get_liked_posts():
         return jsonify({'error': 'Unauthorized'}), 401
 
     try:
-        conn = sqlite3.connect('db/users.db')
+        cursor, limit = parse_page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        conn = get_feed_db()
         c = conn.cursor()
         
-        # Get only liked posts for the current user
-        c.execute('''
-            SELECT 
-                p.id,
-                p.content,
-                p.created_at,
-                u.username,
-                u.id as author_id,
-                COUNT(l2.user_id) as likes,
-                1 as liked
-            FROM posts p
-            JOIN users u ON p.user_id = u.id
-            JOIN likes l1 ON p.id = l1.post_id AND l1.user_id = ?
-            LEFT JOIN likes l2 ON p.id = l2.post_id
-            GROUP BY p.id
-            ORDER BY p.created_at DESC
-        ''', (session['user_id'],))
-        
-        posts = []
-        for row in c.fetchall():
-            posts.append({
-                'id': row[0],
-                'content': row[1],
-                'created_at': row[2],
-                'username': row[3],
-                'isAuthor': row[4] == session['user_id'],
-                'likes': row[5],
-                'liked': bool(row[6])
-            })
+        rows = feed_rows(c, 'liked', session['user_id'], cursor, limit)
         
-        return jsonify(posts)
+        # Every post on this page is liked by definition
+        liked_ids = {row[0] for row in rows}
+        return jsonify(post_page(rows, session['user_id'], limit, liked_ids))
 
     except sqlite3.Error as e:
         return jsonify({'error': 'Database error occurred'}), 500
-    finally:
-        conn.close()
 
 @app.route('/signin', methods=['POST'])
+@rate_limited('signin')
 def signin():
     data = request.get_json()
     username = data.get('username')
@@ -157,26 +2004,36 @@ def signin():
         return jsonify({'error': 'Username and password are required'}), 400
 
     try:
-        conn = sqlite3.connect('db/users.db')
+        conn = get_db()
         c = conn.cursor()
         
         # Get user from database
         c.execute('SELECT id, username, password FROM users WHERE username = ?', (username,))
         user = c.fetchone()
         
-        if not user or user[2] != hash_password(password):
+        if not user:
+            run_in_hash_pool(verify_password, password, DUMMY_PASSWORD_HASH)
+            return jsonify({'error': 'Invalid username or password'}), 401
+
+        matches, needs_rehash = run_in_hash_pool(verify_password, password, user[2])
+        if not matches:
             return jsonify({'error': 'Invalid username or password'}), 401
 
+        # Upgrade legacy or outdated hashes now that we know the password
+        if needs_rehash:
+            c.execute('UPDATE users SET password = ? WHERE id = ?',
+                      (run_in_hash_pool(hash_password, password), user[0]))
+            conn.commit()
+
         # Store user info in session
         session['user_id'] = user[0]
         session['username'] = user[1]
+        user_cache.add(user[0], user[1])
 
         return jsonify({'message': 'Login successful', 'username': username}), 200
 
     except sqlite3.Error as e:
         return jsonify({'error': 'Database error occurred'}), 500
-    finally:
-        conn.close()
 
 @app.route('/logout', methods=['POST'])
 def logout():
@@ -189,46 +2046,279 @@ def get_posts():
         return jsonify({'error': 'Unauthorized'}), 401
 
     try:
-        conn = sqlite3.connect('db/users.db')
+        cursor, limit = parse_page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        conn = get_feed_db()
         c = conn.cursor()
-        
-        # Get all posts with user information and like counts
+        user_id = session['user_id']
+
+        page = feed_cache.get((cursor, limit))
+        if page is None:
+            # A page read from an older snapshot than the latest write is
+            # served but not cached. Its ETag is a hash of what it shows,
+            # so clients holding it revalidate once the snapshot catches up
+            page = feed_cache.put((cursor, limit), query_feed_page(c, cursor, limit),
+                                  limit, g.feed_version)
+
+        # At most MAX_PAGE_SIZE primary key lookups, needed for the ETag too
+        liked_ids = liked_post_ids(c, user_id, page.post_ids, page.archived_ids)
+        etag = page.etag(user_id, liked_ids)
+        if request.if_none_match.contains_weak(etag):
+            feed_cache.count_not_modified()
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
+        response = app.response_class(page.render(user_id, liked_ids),
+                                      mimetype='application/json')
+        response.set_etag(etag)
+        return response
+
+    except sqlite3.Error as e:
+        return jsonify({'error': 'Database error occurred'}), 500
+
+def query_feed_page(c, cursor, limit):
+    """Fetch `limit + 1` rows of the global feed before `cursor`"""
+    return feed_rows(c, 'all', None, cursor, limit)
+
+def fts_query(text):
+    """Turn free text into an FTS5 query matching posts containing every word.
+
+    Words are quoted so user input can't inject FTS5 syntax; the last one
+    is matched as a prefix to support search-as-you-type.
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+# Matches ranked by relevance, newest first; ranking scores every
+# candidate, so this bounds the cost of a search for a common word
+SEARCH_RANK_LIMIT = int(os.environ.get('POSTIBLE_SEARCH_RANK_LIMIT', 1000))
+
+# Search results in posting order, walking the full-text index by rowid
+SEARCH_RECENT_SQL = '''
+    SELECT 
+        p.id,
+        p.content,
+        p.created_at,
+        NULL AS username,
+        p.user_id AS author_id,
+        p.like_count,
+        p.created_at
+    FROM posts_fts f
+    JOIN posts p ON p.id = f.rowid
+    WHERE posts_fts MATCH ?
+      AND f.rowid < ?
+    ORDER BY f.rowid DESC
+    LIMIT ?
+'''
+
+# Search results by bm25 rank (best first, i.e. ascending), then id, among
+# the newest SEARCH_RANK_LIMIT matches
+SEARCH_RANKED_SQL = '''
+    WITH candidates AS (
+        SELECT rowid, rank FROM posts_fts
+        WHERE posts_fts MATCH ?
+        ORDER BY rowid DESC
+        LIMIT ?
+    )
+    SELECT 
+        p.id,
+        p.content,
+        p.created_at,
+        NULL AS username,
+        p.user_id AS author_id,
+        p.like_count,
+        f.rank
+    FROM candidates f
+    JOIN posts p ON p.id = f.rowid
+    WHERE (f.rank, f.rowid) > (?, ?)
+    ORDER BY f.rank, f.rowid
+    LIMIT ?
+'''
+
+@app.route('/posts/search')
+def search_posts():
+    """Full-text search over the hot posts.
+
+    By default results are the newest SEARCH_RANK_LIMIT matches ordered by
+    relevance, paged with `after=<rank>,<id>`; older matches only show up
+    with ?sort=recent, which returns every match newest first, paged with
+    `before=<created_at>,<id>` like the feeds, at a cost that depends only
+    on the page size.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    query = fts_query(request.args.get('q', ''))
+    if query is None:
+        return jsonify({'error': 'Search query is required'}), 400
+
+    try:
+        cursor, limit = parse_page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    sort = request.args.get('sort', 'rank')
+    if sort not in ('rank', 'recent'):
+        return jsonify({'error': 'sort must be rank or recent'}), 400
+
+    # The `after` cursor is the <rank>,<id> of the last ranked result seen
+    after = (float('-inf'), 0)
+    if request.args.get('after'):
+        try:
+            rank, post_id = request.args['after'].rsplit(',', 1)
+            after = (float(rank), int(post_id))
+        except ValueError:
+            return jsonify({'error': 'after must have the form <rank>,<id>'}), 400
+
+    try:
+        conn = get_feed_db()
+        c = conn.cursor()
+
+        if sort == 'recent':
+            c.execute(SEARCH_RECENT_SQL, (query, cursor[1], limit + 1))
+        else:
+            c.execute(SEARCH_RANKED_SQL, (query, SEARCH_RANK_LIMIT, *after, limit + 1))
+        rows = with_usernames(c, c.fetchall())
+
+        liked_ids = liked_post_ids(c, session['user_id'], [row[0] for row in rows[:limit]])
+        return jsonify(post_page(rows, session['user_id'], limit, liked_ids))
+
+    except sqlite3.Error as e:
+        return jsonify({'error': 'Database error occurred'}), 500
+
+def ndjson_posts(*cursors):
+    """Serialize (id, content, created_at, username, like_count) rows as NDJSON"""
+    for rows in (rows for c in cursors for rows in iter_row_batches(c)):
+        yield ''.join(compact_json({
+            'id': row[0],
+            'content': row[1],
+            'created_at': row[2],
+            'username': row[3],
+            'likes': row[4]
+        }) + '\n' for row in rows)
+
+@app.route('/posts/export')
+def export_posts():
+    """Stream every post, or one user's with ?user=<username>, oldest first"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    username = request.args.get('user')
+    try:
+        conn = get_feed_db()
+        c = conn.cursor()
+        cursors = []
+
+        if username:
+            user_id = user_cache.user_id(c, username)
+            if user_id is None:
+                return jsonify({'error': 'User not found'}), 404
+            where, params = 'WHERE p.user_id = ?', (user_id,)
+        else:
+            where, params = '', ()
+
+        # Archived posts are all older than the hot ones, so they come first.
+        # Both orders follow an index, posts(user_id, created_at, id) or
+        # posts(created_at, id), so rows come out without a sort step
+        for table in ('archive.posts', 'posts'):
+            cursors.append(conn.cursor())
+            cursors[-1].execute(f'''
+                SELECT p.id, p.content, p.created_at, u.username, p.like_count
+                FROM {table} p
+                JOIN users u ON p.user_id = u.id
+                {where}
+                ORDER BY p.created_at, p.id
+            ''', params)
+    except sqlite3.Error as e:
+        return jsonify({'error': 'Database error occurred'}), 500
+
+    filename = f'posts-{username}.ndjson' if username else 'posts.ndjson'
+    return stream_response(ndjson_posts(*cursors), mimetype='application/x-ndjson',
+                           headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+MAX_CHANGES = 500
+
+@app.route('/posts/changes')
+def get_changes():
+    """Changes after the `since` sequence number, for clients catching up.
+
+    New posts come back in full and like changes as the post's current
+    count, each deduplicated per post. `more` is set when there are further
+    changes to fetch with the returned `seq`; `reset` means `since` is older
+    than the retained log and the client should reload its feed instead.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    since = request.args.get('since', type=int)
+    user_id = session['user_id']
+
+    try:
+        conn = get_read_db()
+        c = conn.cursor()
+
+        if since is None:
+            return jsonify({'seq': current_change_seq(c), 'posts': [], 'likes': [],
+                            'more': False, 'reset': False})
+
+        c.execute('SELECT MIN(seq) FROM changes')
+        oldest = c.fetchone()[0]
+        if oldest is not None and since < oldest - 1:
+            return jsonify({'seq': current_change_seq(c), 'posts': [], 'likes': [],
+                            'more': False, 'reset': True})
+
         c.execute('''
-            SELECT 
-                p.id,
-                p.content,
-                p.created_at,
-                u.username,
-                u.id as author_id,
-                COUNT(l.user_id) as likes,
-                MAX(CASE WHEN l.user_id = ? THEN 1 ELSE 0 END) as liked
-            FROM posts p
-            JOIN users u ON p.user_id = u.id
-            LEFT JOIN likes l ON p.id = l.post_id
-            GROUP BY p.id
-            ORDER BY p.created_at DESC
-        ''', (session['user_id'],))
-        
+            SELECT seq, kind, post_id FROM changes
+            WHERE seq > ?
+            ORDER BY seq
+            LIMIT ?
+        ''', (since, MAX_CHANGES + 1))
+        changes = c.fetchall()
+        more = len(changes) > MAX_CHANGES
+        changes = changes[:MAX_CHANGES]
+
+        new_ids = list(dict.fromkeys(post_id for _, kind, post_id in changes if kind == 'post'))
+        liked_ids = list(dict.fromkeys(post_id for _, kind, post_id in changes
+                                       if kind == 'likes' and post_id not in new_ids))
         posts = []
-        for row in c.fetchall():
-            posts.append({
-                'id': row[0],
-                'content': row[1],
-                'created_at': row[2],
-                'username': row[3],
-                'isAuthor': row[4] == session['user_id'],
-                'likes': row[5],
-                'liked': bool(row[6])
-            })
-        
-        return jsonify(posts)
+        if new_ids:
+            placeholders = ','.join('?' * len(new_ids))
+            c.execute(f'''
+                SELECT p.id, p.content, p.created_at, NULL, p.user_id, p.like_count, p.created_at
+                FROM posts p
+                WHERE p.id IN ({placeholders})
+                ORDER BY p.created_at, p.id
+            ''', new_ids)
+            rows = with_usernames(c, c.fetchall())
+            posts = post_page(rows, user_id, len(rows),
+                              liked_post_ids(c, user_id, new_ids))['posts']
+        likes = []
+        if liked_ids:
+            placeholders = ','.join('?' * len(liked_ids))
+            c.execute(f'SELECT id, like_count FROM posts WHERE id IN ({placeholders})', liked_ids)
+            likes = [{'post_id': post_id, 'likes': count} for post_id, count in c.fetchall()]
+
+        return jsonify({
+            'seq': changes[-1][0] if changes else since,
+            'posts': posts,
+            'likes': likes,
+            'more': more,
+            'reset': False
+        })
 
     except sqlite3.Error as e:
         return jsonify({'error': 'Database error occurred'}), 500
-    finally:
-        conn.close()
 
 @app.route('/posts', methods=['POST'])
+@rate_limited('post')
 def create_post():
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
@@ -236,57 +2326,46 @@ def create_post():
     data = request.get_json()
     content = data.get('content')
 
-    if not content:
+    if not isinstance(content, str) or not content:
         return jsonify({'error': 'Content is required'}), 400
 
     try:
-        conn = sqlite3.connect('db/users.db')
-        c = conn.cursor()
-        
-        # Insert new post
-        c.execute('''
-            INSERT INTO posts (user_id, content)
-            VALUES (?, ?)
-        ''', (session['user_id'], content))
-        
-        post_id = c.lastrowid
-        conn.commit()
+        post = post_writer.insert([(session['user_id'], session['username'], content)])[0]
+        return jsonify(dict(post, isAuthor=True)), 201
 
-        # Get the created post with user information
-        c.execute('''
-            SELECT 
-                p.id,
-                p.content,
-                p.created_at,
-                u.username,
-                u.id as author_id,
-                0 as likes,
-                0 as liked
-            FROM posts p
-            JOIN users u ON p.user_id = u.id
-            WHERE p.id = ?
-        ''', (post_id,))
-        
-        post = c.fetchone()
-        new_post = {
-            'id': post[0],
-            'content': post[1],
-            'created_at': post[2],
-            'username': post[3],
-            'isAuthor': post[4] == session['user_id'],
-            'likes': post[5],
-            'liked': bool(post[6])
-        }
-        
-        # Emit the new post to all connected clients
-        socketio.emit('new_post', new_post)
-        
-        return jsonify(new_post), 201
+    except sqlite3.Error as e:
+        return jsonify({'error': 'Database error occurred'}), 500
+
+def batch_post_count():
+    """Posts in a /posts/batch request, charged to the post rate limit"""
+    posts = (request.get_json(silent=True) or {}).get('posts')
+    return max(len(posts), 1) if isinstance(posts, list) else 1
+
+@app.route('/posts/batch', methods=['POST'])
+@rate_limited('post', cost=batch_post_count)
+def create_posts_batch():
+    """Create up to MAX_BATCH_POSTS posts in one request and one transaction"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    data = request.get_json(silent=True) or {}
+    posts = data.get('posts')
+    if not isinstance(posts, list) or not posts:
+        return jsonify({'error': 'posts must be a non-empty list'}), 400
+    if len(posts) > MAX_BATCH_POSTS:
+        return jsonify({'error': f'At most {MAX_BATCH_POSTS} posts per batch'}), 400
+
+    contents = [post.get('content') if isinstance(post, dict) else None for post in posts]
+    if not all(isinstance(content, str) and content for content in contents):
+        return jsonify({'error': 'Content is required'}), 400
+
+    try:
+        created = post_writer.insert(
+            [(session['user_id'], session['username'], content) for content in contents])
+        return jsonify({'posts': [dict(post, isAuthor=True) for post in created]}), 201
 
     except sqlite3.Error as e:
         return jsonify({'error': 'Database error occurred'}), 500
-    finally:
-        conn.close()
 
 @app.route('/posts/my')
 def get_my_posts():
@@ -294,53 +2373,53 @@ def get_my_posts():
         return jsonify({'error': 'Unauthorized'}), 401
 
     try:
-        conn = sqlite3.connect('db/users.db')
+        cursor, limit = parse_page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        conn = get_feed_db()
         c = conn.cursor()
         
-        # Get only posts created by the current user
-        c.execute('''
-            SELECT 
-                p.id,
-                p.content,
-                p.created_at,
-                u.username,
-                u.id as author_id,
-                COUNT(l.user_id) as likes,
-                MAX(CASE WHEN l.user_id = ? THEN 1 ELSE 0 END) as liked
-            FROM posts p
-            JOIN users u ON p.user_id = u.id
-            LEFT JOIN likes l ON p.id = l.post_id
-            WHERE p.user_id = ?
-            GROUP BY p.id
-            ORDER BY p.created_at DESC
-        ''', (session['user_id'], session['user_id']))
-        
-        posts = []
-        for row in c.fetchall():
-            posts.append({
-                'id': row[0],
-                'content': row[1],
-                'created_at': row[2],
-                'username': row[3],
-                'isAuthor': True,  # Always true since these are user's own posts
-                'likes': row[5],
-                'liked': bool(row[6])
-            })
+        rows = feed_rows(c, 'my', session['user_id'], cursor, limit)
         
-        return jsonify(posts)
+        # Users cannot like their own posts, so nothing here is liked
+        return jsonify(post_page(rows, session['user_id'], limit, set()))
+
+    except sqlite3.Error as e:
+        return jsonify({'error': 'Database error occurred'}), 500
+
+@app.route('/posts/timeline')
+def get_timeline():
+    """Home timeline: the user's own posts and those of the accounts they follow"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        cursor, limit = parse_page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        conn = get_feed_db()
+        c = conn.cursor()
+        user_id = session['user_id']
+
+        rows = timeline_rows(c, user_id, cursor, limit)
+        liked_ids = liked_post_ids(c, user_id, [row[0] for row in rows[:limit]])
+        return jsonify(post_page(rows, user_id, limit, liked_ids))
 
     except sqlite3.Error as e:
         return jsonify({'error': 'Database error occurred'}), 500
-    finally:
-        conn.close()
 
 @app.route('/posts/<int:post_id>/like', methods=['POST'])
+@rate_limited('like')
 def toggle_like(post_id):
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
 
     try:
-        conn = sqlite3.connect('db/users.db')
+        conn = get_db()
         c = conn.cursor()
 
         # Check if the post exists and if the user is not the author
@@ -348,134 +2427,541 @@ def toggle_like(post_id):
         post = c.fetchone()
         
         if not post:
+            c.execute('SELECT 1 FROM archive.posts WHERE id = ?', (post_id,))
+            if c.fetchone():
+                return jsonify({'error': 'Archived posts cannot be liked'}), 400
             return jsonify({'error': 'Post not found'}), 404
         
         if post[0] == session['user_id']:
             return jsonify({'error': 'Cannot like your own post'}), 400
 
-        # Check if the user has already liked the post
-        c.execute('SELECT * FROM likes WHERE user_id = ? AND post_id = ?',
+        # Unlike the post if the user has already liked it, otherwise like it.
+        # The likes triggers keep posts.like_count in step within the same
+        # transaction.
+        c.execute('DELETE FROM likes WHERE user_id = ? AND post_id = ?',
                  (session['user_id'], post_id))
-        existing_like = c.fetchone()
-
-        if existing_like:
-            # Unlike the post
-            c.execute('DELETE FROM likes WHERE user_id = ? AND post_id = ?',
-                     (session['user_id'], post_id))
+        if c.rowcount:
             action = 'unliked'
         else:
-            # Like the post
             c.execute('INSERT INTO likes (user_id, post_id) VALUES (?, ?)',
                      (session['user_id'], post_id))
             action = 'liked'
 
-        conn.commit()
-
         # Get updated like count
-        c.execute('''
-            SELECT COUNT(*) as likes
-            FROM likes
-            WHERE post_id = ?
-        ''', (post_id,))
-        
+        c.execute('SELECT like_count FROM posts WHERE id = ?', (post_id,))
         like_count = c.fetchone()[0]
+        seq = current_change_seq(c)
 
-        # Emit like update to all clients
-        socketio.emit('like_update', {
-            'post_id': post_id,
-            'likes': like_count,
-            'action': action,
-            'user_id': session['user_id']
-        })
+        conn.commit()
+
+        # Queue the like update; it is coalesced with other updates of this
+        # post. Every toggle is written, so the like rate limit is what
+        # bounds the writes flip-flopping costs
+        feed_cache.likes_changed(post_id, like_count)
+        previous = like_count - 1 if action == 'liked' else like_count + 1
+        event_batcher.likes_changed(post_id, like_count, previous, post[0], seq)
 
         return jsonify({
             'message': f'Post {action}',
-            'likes': like_count
+            'likes': like_count,
+            'liked': action == 'liked'
         }), 200
 
     except sqlite3.Error as e:
         return jsonify({'error': 'Database error occurred'}), 500
-    finally:
-        conn.close()
 
+@app.route('/users/<username>/follow', methods=['POST'])
+@rate_limited('follow')
+def toggle_follow(username):
+    """Follow the user, or unfollow them if already followed"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
 
-def get_random_post_content():
-    """Fetch random content from various APIs for posts"""
-    # List of APIs to try
-    apis = [
-        
-        # Random quotes
-        {
-            'url': 'https://api.quotable.io/random',
-            'parser': lambda r: f'"{r.json()["content"]}" - {r.json()["author"]}'
-        },
-        # Random facts
-        {
-            'url': 'https://uselessfacts.jsph.pl/random.json?language=en',
-            'parser': lambda r: r.json()['text']
-        },
-         # Tech facts
-        {
-            'url': 'http://numbersapi.com/random/trivia?json=true&type=cs',
-            'parser': lambda r: r.json()['text']
-        },
-        
-        {
-            'url': 'https://www.boredapi.com/api/activity',
-            'parser': lambda r: f"Try this activity: {r.json()['activity']}"
-        },
-        {
-            'url': 'https://api.quotable.io/random',
-            'parser': lambda r: f'"{r.json()["content"]}" - {r.json()["author"]}'
-        },
-        {
-            'url': 'https://v2.jokeapi.dev/joke/Any?type=single',
-            'parser': lambda r: f'"{r.json()["joke"]}"'
-        },
-        {
-            'url': 'https://futurism.com/api/v1/articles',
-            'parser': lambda r: f"{r.json()['articles'][0]['title']}<br>URL : {r.json()['articles'][0]['url']}"
-        },
-        
-        {
-            'url': 'https://techcrunch.com/wp-json/wp/v2/posts?per_page=1',
-            'parser': lambda r: f"{r.json()[0]['title']['rendered']} <br>URL : {r.json()[0]['link']}"
+    try:
+        conn = get_db()
+        c = conn.cursor()
+        follower_id = session['user_id']
 
+        followee_id = user_cache.user_id(c, username)
+        if followee_id is None:
+            return jsonify({'error': 'User not found'}), 404
+        if followee_id == follower_id:
+            return jsonify({'error': 'Cannot follow yourself'}), 400
+
+        # The follows triggers keep users.follower_count in step
+        c.execute('DELETE FROM follows WHERE follower_id = ? AND followee_id = ?',
+                  (follower_id, followee_id))
+        if c.rowcount:
+            action = 'unfollowed'
+            # Walks the followee's posts and deletes by timeline primary key
+            c.execute('''
+                DELETE FROM timeline
+                WHERE user_id = ?
+                  AND (created_at, post_id) IN (SELECT created_at, id FROM posts WHERE user_id = ?)
+            ''', (follower_id, followee_id))
+        else:
+            action = 'followed'
+            c.execute('INSERT INTO follows (follower_id, followee_id) VALUES (?, ?)',
+                      (follower_id, followee_id))
+            c.execute('''
+                UPDATE users SET fanout_on_read = 1
+                WHERE id = ? AND follower_count > ?
+            ''', (followee_id, FANOUT_FOLLOWER_LIMIT))
+            # Start the timeline off with the account's recent posts; those
+            # of a fan-out-on-read account are merged in when reading
+            c.execute('''
+                INSERT OR IGNORE INTO timeline (user_id, created_at, post_id)
+                SELECT ?, p.created_at, p.id
+                FROM posts p
+                JOIN users u ON u.id = p.user_id
+                WHERE p.user_id = ? AND NOT u.fanout_on_read
+                ORDER BY p.created_at DESC, p.id DESC
+                LIMIT ?
+            ''', (follower_id, followee_id, TIMELINE_BACKFILL))
+
+        c.execute('SELECT follower_count FROM users WHERE id = ?', (followee_id,))
+        followers = c.fetchone()[0]
+        conn.commit()
+
+        return jsonify({
+            'message': f'User {action}',
+            'following': action == 'followed',
+            'followers': followers
+        }), 200
+
+    except sqlite3.Error as e:
+        return jsonify({'error': 'Database error occurred'}), 500
+
+@app.route('/stats')
+def get_stats():
+    """Internal counters of the caches and the background content pipeline"""
+    return jsonify({
+        'feed_cache': feed_cache.stats(),
+        'user_cache': user_cache.stats(),
+        'content_buffer': content_buffer.stats(),
+        'content_sources': content_fetcher.stats(),
+        'post_writer': post_writer.stats(),
+        'rate_limits': rate_limiter.stats(),
+        'collapsed_like_updates': event_batcher.collapsed,
+        'archive': archive_stats,
+        'dedupe': dedupe_stats,
+        'read_snapshot': read_snapshot.stats() if read_snapshot else None,
+        'slow_queries': list(slow_queries)
+    })
+
+@app.route('/metrics')
+def get_metrics():
+    """Prometheus scrape endpoint"""
+    metrics.set('postible_content_buffer_items', content_buffer.stats()['size'])
+    cache_stats = feed_cache.stats()
+    for result in ('hits', 'misses', 'not_modified'):
+        metrics.set('postible_feed_cache_lookups_total', cache_stats[result],
+                    (('result', result),))
+    cache_stats = user_cache.stats()
+    for result in ('hits', 'misses'):
+        metrics.set('postible_user_cache_lookups_total', cache_stats[result],
+                    (('result', result),))
+    writer_stats = post_writer.stats()
+    metrics.set('postible_post_write_transactions_total', writer_stats['transactions'])
+    metrics.set('postible_posts_written_total', writer_stats['posts'])
+    limiter_stats = rate_limiter.stats()
+    for result in ('allowed', 'limited'):
+        for rule, count in limiter_stats[result].items():
+            metrics.set('postible_rate_limit_decisions_total', count,
+                        (('rule', rule), ('result', result)))
+    metrics.set('postible_like_updates_collapsed_total', event_batcher.collapsed)
+    return app.response_class(metrics.render(),
+                              mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# List of APIs to fetch post content from
+CONTENT_SOURCES = [
+    
+    # Random quotes
+    {
+        'url': 'https://api.quotable.io/random',
+        'parser': lambda r: f'"{r.json()["content"]}" - {r.json()["author"]}'
+    },
+    # Random facts
+    {
+        'url': 'https://uselessfacts.jsph.pl/random.json?language=en',
+        'parser': lambda r: r.json()['text']
+    },
+     # Tech facts
+    {
+        'url': 'http://numbersapi.com/random/trivia?json=true&type=cs',
+        'parser': lambda r: r.json()['text']
+    },
+    
+    {
+        'url': 'https://www.boredapi.com/api/activity',
+        'parser': lambda r: f"Try this activity: {r.json()['activity']}"
+    },
+    {
+        'url': 'https://v2.jokeapi.dev/joke/Any?type=single',
+        'parser': lambda r: f'"{r.json()["joke"]}"'
+    },
+    {
+        'url': 'https://futurism.com/api/v1/articles',
+        'parser': lambda r: f"{r.json()['articles'][0]['title']}<br>URL : {r.json()['articles'][0]['url']}"
+    },
+    
+    {
+        'url': 'https://techcrunch.com/wp-json/wp/v2/posts?per_page=1',
+        'parser': lambda r: f"{r.json()[0]['title']['rendered']} <br>URL : {r.json()[0]['link']}"
+
+    }
+
+
+]
+
+FALLBACK_CONTENT = "Just thinking about how amazing technology is! 💭"
+
+# Sources raced at once, per-request timeout and overall deadline (seconds)
+FETCH_FANOUT = int(os.environ.get('POSTIBLE_FETCH_FANOUT', 3))
+FETCH_TIMEOUT = float(os.environ.get('POSTIBLE_FETCH_TIMEOUT', 4))
+FETCH_DEADLINE = float(os.environ.get('POSTIBLE_FETCH_DEADLINE', 6))
+# Total time create_seed_posts may spend fetching content
+SEED_FETCH_DEADLINE = float(os.environ.get('POSTIBLE_SEED_FETCH_DEADLINE', 30))
+
+def clean_post_content(content):
+    """Unescape HTML entities and trim fetched content to post size"""
+    return unescape(content)[:400].strip()
+
+class CircuitBreaker:
+    """Stops calling a source after repeated failures.
+
+    After `threshold` consecutive failures the breaker opens for `cooldown`
+    seconds; once that passes a single trial call is let through, which
+    either closes it again or re-opens it.
+    """
+
+    def __init__(self, threshold=3, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        return self.state != 'open'
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+class SourceStats:
+    """Circuit breaker and latency tracking for one content source"""
+
+    def __init__(self, source):
+        self.source = source
+        self.breaker = CircuitBreaker()
+        self.successes = 0
+        self.failures = 0
+        # Exponentially weighted moving average of successful fetches
+        self.latency = None
+
+    def record(self, ok, elapsed):
+        if ok:
+            self.successes += 1
+            self.breaker.record_success()
+            self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+        else:
+            self.failures += 1
+            self.breaker.record_failure()
+
+    def as_dict(self):
+        return {
+            'url': self.source['url'],
+            'state': self.breaker.state,
+            'successes': self.successes,
+            'failures': self.failures,
+            'latency_ms': None if self.latency is None else round(self.latency * 1000, 1)
         }
 
+class ContentFetcher:
+    """Races several content sources and returns the first usable response.
+
+    Requests go through one pooled keep-alive session. Sources whose circuit
+    breaker is open are skipped, and every fetch is bounded by an overall
+    deadline, so a call never blocks for longer than `deadline` seconds.
+    """
+
+    def __init__(self, sources, fanout=FETCH_FANOUT, timeout=FETCH_TIMEOUT,
+                 deadline=FETCH_DEADLINE):
+        self.sources = [SourceStats(source) for source in sources]
+        self.fanout = fanout
+        self.timeout = timeout
+        self.deadline = deadline
+        self._lock = Lock()
+        self._session = None
+        self.executor = ThreadPoolExecutor(max_workers=fanout * 2,
+                                           thread_name_prefix='content-fetch')
 
-    ]
+    @property
+    def session(self):
+        """Keep-alive session, created on the first fetch so that starting
+        the app doesn't pay for importing requests"""
+        with self._lock:
+            if self._session is None:
+                import requests
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=len(self.sources),
+                                                        pool_maxsize=self.fanout * 2)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
 
-    # Try each API until we get a successful response
-    for api in random.sample(apis, len(apis)):
+    def _fetch_one(self, stats, timeout):
+        start = time.monotonic()
+        ok = False
         try:
-            response = requests.get(api['url'], timeout=5)
-            if response.status_code == 200:
-                content = api['parser'](response)
-                # Ensure content isn't too long and clean it up
-                content = unescape(content)[:400].strip()
-                return content
-        except Exception as e:
-            continue
+            response = self.session.get(stats.source['url'], timeout=timeout)
+            if response.status_code != 200:
+                return None
+            content = clean_post_content(stats.source['parser'](response))
+            ok = bool(content)
+            return content or None
+        except Exception:
+            return None
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                stats.record(ok, elapsed)
+            metrics.observe('postible_content_fetch_duration_seconds', elapsed,
+                            (('source', urlparse(stats.source['url']).netloc),
+                             ('outcome', 'ok' if ok else 'error')))
+
+    def fetch(self, deadline=None):
+        """Return cleaned content from the first source to answer, or None.
+
+        `deadline` overrides the configured overall deadline in seconds.
+        """
+        end = time.monotonic() + (self.deadline if deadline is None else deadline)
+        with self._lock:
+            candidates = [stats for stats in self.sources if stats.breaker.allow()]
+        random.shuffle(candidates)
+
+        pending = set()
+        while candidates or pending:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            # Keep `fanout` requests in flight until one succeeds
+            while candidates and len(pending) < self.fanout:
+                stats = candidates.pop()
+                pending.add(self.executor.submit(
+                    self._fetch_one, stats, min(self.timeout, remaining)))
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.result():
+                    return future.result()
+        return None
+
+    def stats(self):
+        with self._lock:
+            return [stats.as_dict() for stats in self.sources]
+
+content_fetcher = ContentFetcher(CONTENT_SOURCES)
+
+def get_random_post_content(deadline=None):
+    """Fetch random content from various APIs for posts"""
+    content = content_fetcher.fetch(deadline)
+    if content:
+        return content
 
     # Fallback content if all APIs fail
-    return "Just thinking about how amazing technology is! 💭"
+    return FALLBACK_CONTENT
+
+CONTENT_BUFFER_SIZE = int(os.environ.get('POSTIBLE_CONTENT_BUFFER_SIZE', 20))
+# Where the buffer is saved between restarts; empty to keep it in memory only
+CONTENT_BUFFER_PATH = os.environ.get('POSTIBLE_CONTENT_BUFFER_PATH', 'db/content_buffer.json')
+
+def content_hash(content):
+    """Hash of content with case and whitespace normalized away"""
+    normalized = ' '.join(content.lower().split())
+    return hashlib.sha1(normalized.encode()).hexdigest()
+
+# MinHash signatures are split into bands for locality-sensitive lookup:
+# posts sharing any band are compared in full. 16 bands of 4 rows make
+# pairs from about 50% shingle overlap up likely candidates, and
+# NEAR_DUPLICATE_SIMILARITY is the Jaccard similarity that counts.
+MINHASH_BANDS = 16
+MINHASH_ROWS = 4
+NEAR_DUPLICATE_SIMILARITY = 0.8
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_random = random.Random(42)
+_MINHASH_PARAMS = [(_minhash_random.randrange(1, _MINHASH_PRIME),
+                    _minhash_random.randrange(_MINHASH_PRIME))
+                   for _ in range(MINHASH_BANDS * MINHASH_ROWS)]
+
+def shingles(content):
+    """Word 3-grams of the content, ignoring case and punctuation"""
+    words = re.findall(r'\w+', content.lower())
+    if len(words) < 3:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + 3]) for i in range(len(words) - 2)}
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def minhash_bands(content):
+    """Band keys of the content's MinHash signature, as signed 64-bit ints"""
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), 'big')
+              for shingle in shingles(content)]
+    signature = [min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_PARAMS]
+    bands = []
+    for band in range(MINHASH_BANDS):
+        rows = signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]
+        digest = hashlib.blake2b(repr((band, rows)).encode(), digest_size=8).digest()
+        bands.append(int.from_bytes(digest, 'big', signed=True))
+    return bands
+
+class ContentBuffer:
+    """Bounded queue of pre-fetched post content, refilled in the background.
+
+    A producer thread keeps the queue topped up ahead of demand so bot posts
+    can be created without waiting on the network. Content is deduplicated
+    by content_hash against both the queue and recently served items.
+    """
+
+    def __init__(self, fetcher, capacity, path=None):
+        self.fetcher = fetcher
+        self.capacity = capacity
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._items = deque()
+        # Hashes of queued and recently served content, oldest first
+        self._seen = OrderedDict()
+        self._lock = Lock()
+        self._wanted = Event()
+        self._save_lock = Lock()
+        self._thread = None
+        self._load()
+
+    def _remember(self, digest):
+        self._seen[digest] = True
+        self._seen.move_to_end(digest)
+        while len(self._seen) > self.capacity * 50:
+            self._seen.popitem(last=False)
+
+    def put(self, content):
+        """Queue content unless it is a duplicate or the buffer is full"""
+        digest = content_hash(content)
+        with self._lock:
+            if digest in self._seen or len(self._items) >= self.capacity:
+                return False
+            self._items.append(content)
+            self._remember(digest)
+        self._save()
+        return True
+
+    def get(self, deadline=None):
+        """Return buffered content, fetching directly if the buffer is empty"""
+        with self._lock:
+            content = self._items.popleft() if self._items else None
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self._wanted.set()
+        if content is None:
+            return get_random_post_content(deadline)
+        self._save()
+        return content
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._produce, daemon=True)
+            self._thread.start()
+
+    def _produce(self):
+        backoff = 1
+        while True:
+            if len(self._items) >= self.capacity:
+                self._wanted.wait(timeout=60)
+                self._wanted.clear()
+                continue
+            content = self.fetcher.fetch()
+            if content:
+                self.put(content)
+                backoff = 1
+            else:
+                # Every source failed or timed out; wait before trying again
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                items = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not load content buffer: {e}")
+            return
+        for content in items[:self.capacity]:
+            digest = content_hash(content)
+            if digest not in self._seen:
+                self._items.append(content)
+                self._remember(digest)
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = f'{self.path}.tmp'
+        try:
+            # Snapshot under the save lock so an older snapshot can never
+            # overwrite a newer one
+            with self._save_lock:
+                with self._lock:
+                    items = list(self._items)
+                with open(tmp_path, 'w') as f:
+                    json.dump(items, f)
+                os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not save content buffer: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+content_buffer = ContentBuffer(content_fetcher, CONTENT_BUFFER_SIZE, CONTENT_BUFFER_PATH)
 
 def create_seed_posts():
     """Create random posts for seed users using web content"""
     try:
-        conn = sqlite3.connect('db/users.db')
-        c = conn.cursor()
-        
-        # Get all users
-        c.execute('SELECT id, username FROM users')
-        users = c.fetchall()
-        
+        with db_pool.connection() as conn:
+            c = conn.cursor()
+            
+            # Get all users
+            c.execute('SELECT id, username FROM users')
+            users = c.fetchall()
+            
         if not users:
             print("No users found in database")
             return
         
-        # Create 10 rounds of posts
+        # Create 10 rounds of posts, fetching within one overall deadline
+        seed_deadline = time.monotonic() + SEED_FETCH_DEADLINE
         for round_num in range(10):
             # Select random subset of users for this round
             posting_users = random.sample(
@@ -483,72 +2969,86 @@ def create_seed_posts():
                 random.randint(1, min(3, len(users)))
             )
             
+            # Get content from web APIs before handing the round to the
+            # writer, so the write lock isn't held across fetches
+            round_posts = []
             for user in posting_users:
-                # Get content from web APIs
-                post_content = get_random_post_content()
-                c.execute(
-                    'INSERT INTO posts (user_id, content) VALUES (?, ?)',
-                    (user[0], post_content)
-                )
-                
-                print(f"Created post for {user[1]}: {post_content[:50]}...")
+                remaining = seed_deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                content = fresh_bot_content(min(remaining, FETCH_DEADLINE),
+                                            [post[2] for post in round_posts])
+                if content is not None:
+                    round_posts.append((user[0], user[1], content))
+            
+            if round_posts:
+                index_bot_posts(post_writer.insert(round_posts))
+            for _, username, post_content in round_posts:
+                print(f"Created post for {username}: {post_content[:50]}...")
                 
-            conn.commit()
-            sleep(1)  # Slightly longer delay to respect API rate limits
+            if time.monotonic() >= seed_deadline:
+                print("Seed content deadline reached, stopping early")
+                break
             
         print("Finished creating seed posts")
         
     except sqlite3.Error as e:
         print(f"Database error: {e}")
-    finally:
-        conn.close()
 
 
 
+SEED_USERNAMES = [
+    'josh01', 'almondbabe', 'danaflow', 'old_zealand',
+    'legumeister', 'no-pro', 'zmey', 'freund', 'samara', 'despasito'
+]
+
 def generate_password(length=6):
     """Generate a random password of specified length"""
     characters = string.ascii_letters + string.digits + "!@#$%^&*"
     return ''.join(random.choice(characters) for _ in range(length))
 
 def create_seed_users():
-    """Create 10 predefined users if they don't exist"""
-    usernames = [
-        'josh01', 'almondbabe', 'danaflow', 'old_zealand', 
-        'legumeister', 'no-pro', 'zmey', 'freund', 'samara', 'despasito'
-    ]
-    
-    created_users = []
-    
+    """Create the predefined seed users that don't exist yet.
+
+    Only missing users get a password hashed, outside of any connection, and
+    they are inserted with a single INSERT OR IGNORE, so a restart or
+    another worker seeding at the same time leaves existing accounts alone.
+    """
     try:
-        conn = sqlite3.connect('db/users.db')
-        c = conn.cursor()
-        
-        for username in usernames:
-            # Check if user exists
-            c.execute('SELECT username FROM users WHERE username = ?', (username,))
-            if not c.fetchone():
-                password = generate_password()
-                hashed_password = hash_password(password)
-                
-                c.execute(
-                    'INSERT INTO users (username, password) VALUES (?, ?)',
-                    (username, hashed_password)
-                )
-                
-                created_users.append({
-                    'username': username,
-                    'password': password  # Store unhashed for testing purposes
-                })
-        
-        conn.commit()
-        print(f"Created {len(created_users)} new seed users")
-        return created_users
-        
+        with db_pool.connection() as conn:
+            c = conn.cursor()
+            placeholders = ', '.join(['?'] * len(SEED_USERNAMES))
+            c.execute(f'SELECT username FROM users WHERE username IN ({placeholders})',
+                      SEED_USERNAMES)
+            existing = {row[0] for row in c.fetchall()}
+
+        passwords = {username: generate_password()
+                     for username in SEED_USERNAMES if username not in existing}
+        if not passwords:
+            return []
+        params = []
+        for username, password in passwords.items():
+            params += [username, run_in_hash_pool(hash_password, password)]
+
+        with db_pool.connection() as conn:
+            c = conn.cursor()
+            rows = ', '.join(['(?, ?, 1)'] * len(passwords))
+            # Bots are fanned out on read, see migration_follows_timeline
+            c.execute(f'INSERT OR IGNORE INTO users (username, password, fanout_on_read) '
+                      f'VALUES {rows} RETURNING username', params)
+            inserted = [row[0] for row in c.fetchall()]
+            conn.commit()
+        for username in inserted:
+            user_cache.invalidate(username=username)
+
+        print(f"Created {len(inserted)} new seed users")
+        # Unhashed passwords are kept for testing purposes
+        return [{'username': username, 'password': passwords[username]}
+                for username in inserted]
+
     except sqlite3.Error as e:
         print(f"Database error: {e}")
         return []
-    finally:
-        conn.close()
 
 def initialize_with_seed_data():
     created_users = create_seed_users()
@@ -559,90 +3059,575 @@ def initialize_with_seed_data():
     create_seed_posts()
 
 
+# Seconds between bot posts
+AUTO_POST_INTERVAL = float(os.environ.get('POSTIBLE_AUTO_POST_INTERVAL', 120))
+
 def auto_post_content():
+    """Create one post as a random seed user; run by the scheduler every
+    AUTO_POST_INTERVAL seconds"""
+    random_username = random.choice(SEED_USERNAMES)
+
+    # Get the user_id for the random username
+    with db_pool.connection() as conn:
+        user_id = user_cache.user_id(conn.cursor(), random_username)
+    if user_id is None:
+        return
+
+    # Get random content for the post, pre-fetched when possible
+    content = fresh_bot_content()
+    if content is None:
+        print(f"Skipped auto-post as {random_username}: only duplicate content")
+        return
+
+    # The writer commits it and queues it for the clients
+    index_bot_posts(post_writer.insert([(user_id, random_username, content)]))
+    print(f"Auto-posted as {random_username}: {content[:50]}...")
+
+# Pieces of content a bot tries before skipping its turn when each one
+# duplicates an earlier bot post
+DEDUPE_ATTEMPTS = 3
+DEDUPE_BATCH_SIZE = 500
+DEDUPE_BATCH_PAUSE = 0.05
+dedupe_stats = {'skipped': 0, 'refetched': 0, 'merged': 0, 'likes_moved': 0, 'last_run': None}
+
+def bot_user_ids(c):
+    user_ids = [user_cache.user_id(c, username) for username in SEED_USERNAMES]
+    return [user_id for user_id in user_ids if user_id is not None]
+
+def find_duplicate(c, content, bot_ids, before_id=2**63 - 1):
+    """Id of the earliest bot post before `before_id` that the content
+    duplicates, exactly after normalization or nearly by MinHash, or None"""
+    c.execute(f'''
+        SELECT id FROM posts
+        WHERE content_hash = ? AND id < ? AND user_id IN ({','.join('?' * len(bot_ids))})
+        ORDER BY id LIMIT 1
+    ''', (content_hash(content), before_id, *bot_ids))
+    row = c.fetchone()
+    if row:
+        return row[0]
+
+    # Only bot posts have bands, so every candidate is one
+    bands = minhash_bands(content)
+    c.execute(f'''
+        SELECT DISTINCT p.id, p.content
+        FROM content_bands b
+        JOIN posts p ON p.id = b.post_id
+        WHERE b.band IN ({','.join('?' * len(bands))}) AND p.id < ?
+        ORDER BY p.id
+    ''', (*bands, before_id))
+    words = shingles(content)
+    for post_id, other in c.fetchall():
+        if jaccard(words, shingles(other)) >= NEAR_DUPLICATE_SIMILARITY:
+            return post_id
+    return None
+
+def fresh_bot_content(deadline=None, pending=()):
+    """Content for a bot post that doesn't duplicate an earlier bot post,
+    nor any of `pending`, content picked for posts not written yet; None
+    when DEDUPE_ATTEMPTS pieces in a row all did"""
+    for attempt in range(DEDUPE_ATTEMPTS):
+        content = content_buffer.get(deadline)
+        words = shingles(content)
+        if not any(content_hash(other) == content_hash(content)
+                   or jaccard(words, shingles(other)) >= NEAR_DUPLICATE_SIMILARITY
+                   for other in pending):
+            with db_pool.connection() as conn:
+                duplicate = find_duplicate(conn.cursor(), content, bot_user_ids(conn.cursor()))
+            if duplicate is None:
+                return content
+        dedupe_stats['refetched'] += 1
+    dedupe_stats['skipped'] += 1
+    return None
+
+def index_bot_posts(posts):
+    """Record the MinHash bands of newly written bot posts"""
+    with db_pool.connection() as conn:
+        conn.executemany('INSERT OR IGNORE INTO content_bands (band, post_id) VALUES (?, ?)',
+                         [(band, post['id']) for post in posts
+                          for band in minhash_bands(post['content'])])
+        conn.commit()
+
+def merge_duplicate(c, post_id, keep_id):
+    """Move the likes of a duplicate post to the post it duplicates, then
+    delete it; returns the number of likes moved"""
+    c.execute('''
+        INSERT OR IGNORE INTO likes (user_id, post_id, created_at)
+        SELECT user_id, ?, created_at FROM likes
+        WHERE post_id = ? AND user_id != (SELECT user_id FROM posts WHERE id = ?)
+    ''', (keep_id, post_id, keep_id))
+    moved = c.rowcount
+    # Post first, so the like count triggers find nothing to update
+    c.execute('DELETE FROM posts WHERE id = ?', (post_id,))
+    c.execute('DELETE FROM likes WHERE post_id = ?', (post_id,))
+    c.execute('DELETE FROM timeline WHERE post_id = ?', (post_id,))
+    c.execute('DELETE FROM content_bands WHERE post_id = ?', (post_id,))
+    return moved
+
+def dedupe_posts():
+    """Hash the posts written before content hashing, in bounded batches
+    and oldest first. A bot post that duplicates an earlier bot post is
+    merged into it, likes included; the others get their hash and bands.
+    Resumes where it stopped, since only unhashed posts are visited."""
+    merged = moved = 0
+    with db_pool.connection() as conn:
+        c = conn.cursor()
+        bot_ids = bot_user_ids(c)
+        while not scheduler.stopping:
+            c.execute('''
+                SELECT id, user_id, content FROM posts
+                WHERE content_hash IS NULL
+                ORDER BY id LIMIT ?
+            ''', (DEDUPE_BATCH_SIZE,))
+            rows = c.fetchall()
+            if not rows:
+                break
+            c.execute('BEGIN IMMEDIATE')
+            for post_id, user_id, content in rows:
+                if user_id in bot_ids:
+                    keep_id = find_duplicate(c, content, bot_ids, post_id)
+                    if keep_id is not None:
+                        moved += merge_duplicate(c, post_id, keep_id)
+                        merged += 1
+                        continue
+                    c.executemany('INSERT OR IGNORE INTO content_bands (band, post_id) VALUES (?, ?)',
+                                  [(band, post_id) for band in minhash_bands(content)])
+                c.execute('UPDATE posts SET content_hash = ? WHERE id = ?',
+                          (content_hash(content), post_id))
+            conn.commit()
+            time.sleep(DEDUPE_BATCH_PAUSE)
+
+    dedupe_stats['merged'] += merged
+    dedupe_stats['likes_moved'] += moved
+    dedupe_stats['last_run'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    if merged:
+        print(f"Merged {merged} duplicate bot posts and {moved} of their likes")
+
+# Posts older than this many days move to the archive database; 0 disables
+ARCHIVE_AFTER_DAYS = float(os.environ.get('POSTIBLE_ARCHIVE_AFTER_DAYS', 90))
+ARCHIVE_INTERVAL = float(os.environ.get('POSTIBLE_ARCHIVE_INTERVAL', 3600))
+# Posts moved per write transaction, and the pause between transactions
+# that lets request writers take the lock in between
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_BATCH_PAUSE = 0.05
+VACUUM_STEP_PAGES = 1000
+archive_stats = {'runs': 0, 'posts': 0, 'likes': 0, 'freed_pages': 0, 'last_run': None}
+
+def copy_to_archive(c, post_ids):
+    """Copy posts and their likes into the archive; return the like count"""
+    placeholders = ','.join('?' * len(post_ids))
+    c.execute(f'''
+        INSERT OR REPLACE INTO archive.posts (id, user_id, content, created_at, like_count)
+        SELECT id, user_id, content, created_at, like_count
+        FROM posts WHERE id IN ({placeholders})
+    ''', post_ids)
+    c.execute(f'''
+        INSERT OR REPLACE INTO archive.likes (user_id, post_id, created_at)
+        SELECT user_id, post_id, created_at
+        FROM likes WHERE post_id IN ({placeholders})
+    ''', post_ids)
+    return c.rowcount
+
+def archive_batch(conn, cutoff):
+    """Move the oldest posts created before cutoff, up to ARCHIVE_BATCH_SIZE,
+    and their likes. Returns (posts, likes) moved."""
+    c = conn.cursor()
+    c.execute('SELECT id FROM posts WHERE created_at < ? ORDER BY created_at, id LIMIT ?',
+              (cutoff, ARCHIVE_BATCH_SIZE))
+    post_ids = [row[0] for row in c.fetchall()]
+    if not post_ids:
+        return 0, 0
+
+    # In WAL mode a commit spanning two database files is only atomic per
+    # file, so the copy is made durable on its own first: a crash then
+    # leaves posts in both databases, never in neither
+    c.execute('BEGIN IMMEDIATE')
+    copy_to_archive(c, post_ids)
+    conn.commit()
+
+    placeholders = ','.join('?' * len(post_ids))
+    c.execute('BEGIN IMMEDIATE')
+    # Copied again to pick up likes given in between
+    likes = copy_to_archive(c, post_ids)
+    # Posts go first, so the like count triggers find nothing to update and
+    # the change log isn't flooded with the deletes
+    c.execute(f'DELETE FROM posts WHERE id IN ({placeholders})', post_ids)
+    c.execute(f'DELETE FROM likes WHERE post_id IN ({placeholders})', post_ids)
+    c.execute(f'DELETE FROM timeline WHERE post_id IN ({placeholders})', post_ids)
+    c.execute(f'DELETE FROM content_bands WHERE post_id IN ({placeholders})', post_ids)
+    conn.commit()
+    return len(post_ids), likes
+
+def incremental_vacuum(conn):
+    """Return the hot database's free pages to the OS; return how many"""
+    c = conn.cursor()
+    c.execute('PRAGMA auto_vacuum')
+    if c.fetchone()[0] != 2:
+        # Not switched yet, see enable_incremental_vacuum
+        return 0
+
+    c.execute('PRAGMA freelist_count')
+    start = free = c.fetchone()[0]
+    # Small steps, each its own short write transaction, stopping early on
+    # shutdown; the next run frees the rest
+    while free and not scheduler.stopping:
+        # Through execute the pragma is stepped once, freeing a single page;
+        # executescript runs it to completion
+        conn.executescript(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})')
+        c.execute('PRAGMA freelist_count')
+        free = c.fetchone()[0]
+        if free:
+            time.sleep(ARCHIVE_BATCH_PAUSE)
+    return start - free
+
+def archive_old_posts():
+    """Move posts older than ARCHIVE_AFTER_DAYS to the archive database in
+    bounded batches, then compact the hot database"""
+    cutoff = (datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    posts = likes = 0
+    with db_pool.connection() as conn:
+        # Stop between batches when the server shuts down; the rest is
+        # picked up by the next run
+        while not scheduler.stopping:
+            batch_posts, batch_likes = archive_batch(conn, cutoff)
+            if not batch_posts:
+                break
+            posts += batch_posts
+            likes += batch_likes
+            time.sleep(ARCHIVE_BATCH_PAUSE)
+        freed = incremental_vacuum(conn) if posts else 0
+
+    archive_stats['runs'] += 1
+    archive_stats['posts'] += posts
+    archive_stats['likes'] += likes
+    archive_stats['freed_pages'] += freed
+    archive_stats['last_run'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    if posts:
+        print(f"Archived {posts} posts and {likes} likes created before {cutoff}, "
+              f"freed {freed} pages")
+
+SCHEDULER_WORKERS = int(os.environ.get('POSTIBLE_SCHEDULER_WORKERS', 2))
+# Failed runs are retried after JOB_RETRY_BASE seconds, doubling on every
+# consecutive failure up to JOB_RETRY_MAX (or the job's interval)
+JOB_RETRY_BASE = 5
+JOB_RETRY_MAX = 600
+
+def utc_timestamp(at=None):
+    return datetime.utcfromtimestamp(time.time() if at is None else at).strftime('%Y-%m-%d %H:%M:%S')
+
+class Job:
+    """A function run by the scheduler, once or every `interval` seconds"""
+
+    def __init__(self, name, fn, interval, delay, jitter, max_retries):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.jitter = jitter
+        self.max_retries = max_retries
+        self.next_run = time.monotonic() + delay
+        self.state = 'scheduled'
+        self.paused = False
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_started = None
+        self.last_duration = None
+        self.last_error = None
+
+    def jittered(self, delay):
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def snapshot(self):
+        next_run = None
+        if self.next_run is not None and not self.running:
+            next_run = utc_timestamp(time.time() + max(0, self.next_run - time.monotonic()))
+        return {
+            'name': self.name,
+            'status': 'paused' if self.paused else self.state,
+            'interval': self.interval,
+            'runs': self.runs,
+            'failures': self.failures,
+            'last_started': self.last_started,
+            'last_duration': self.last_duration,
+            'last_error': self.last_error,
+            'next_run': next_run
+        }
+
+class Scheduler:
+    """In-process scheduler for recurring and one-off background jobs.
+
+    A dispatcher thread hands due jobs to a pool of worker threads, so
+    blocking network and database work never runs on the event loop. A job
+    never overlaps itself: its next run is scheduled, with jitter, once the
+    current one finishes. Failed runs are retried with exponential backoff;
+    a one-off job gives up after max_retries.
     """
-    Automatically creates posts every 5 minutes using random seed users.
-    Runs in a separate thread while the server is running.
-    """
-    # Copy the list of usernames to avoid modifying the original
-    usernames = [
-        'josh01', 'almondbabe', 'danaflow', 'old_zealand', 
-        'legumeister', 'no-pro', 'zmey', 'freund', 'samara', 'despasito'
-    ]
-    
-    while True:
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._jobs = {}
+        self._cond = Condition()
+        self._ready = queue.Queue()
+        self._threads = []
+        self._retiring = 0
+        self._stopping = Event()
+        self._dispatcher = None
+
+    @property
+    def stopping(self):
+        return self._stopping.is_set()
+
+    def add(self, name, fn, interval=None, delay=0, jitter=0.1, max_retries=3):
+        with self._cond:
+            self._jobs[name] = Job(name, fn, interval, delay, jitter, max_retries)
+            self._cond.notify()
+
+    def start(self):
+        with self._cond:
+            if self._dispatcher is not None:
+                return
+            self._dispatcher = Thread(target=self._dispatch, daemon=True)
+            self._dispatcher.start()
+        self.resize(self.workers)
+
+    def pause(self, name):
+        with self._cond:
+            self._jobs[name].paused = True
+
+    def resume(self, name):
+        with self._cond:
+            self._jobs[name].paused = False
+            self._cond.notify()
+
+    def run_now(self, name):
+        with self._cond:
+            job = self._jobs[name]
+            if job.next_run is None or job.next_run > time.monotonic():
+                job.next_run = time.monotonic()
+            self._cond.notify()
+
+    def resize(self, workers):
+        """Grow or shrink the worker pool; shrinking lets running jobs finish"""
+        with self._cond:
+            self.workers = workers
+            active = len(self._threads) - self._retiring
+            for _ in range(workers - active):
+                thread = Thread(target=self._work, daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            for _ in range(active - workers):
+                self._retiring += 1
+                self._ready.put(None)
+
+    def shutdown(self, timeout=10):
+        """Stop starting jobs and give running ones up to timeout to finish"""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        with self._cond:
+            self._cond.notify_all()
+            threads = list(self._threads)
+        for _ in threads:
+            self._ready.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+    def _dispatch(self):
+        with self._cond:
+            while not self._stopping.is_set():
+                now = time.monotonic()
+                waiting = [job for job in self._jobs.values()
+                           if not job.paused and not job.running and job.next_run is not None]
+                for job in waiting:
+                    if job.next_run <= now:
+                        job.running = True
+                        job.state = 'queued'
+                        self._ready.put(job)
+                upcoming = [job.next_run for job in waiting if not job.running]
+                self._cond.wait(min(upcoming) - now if upcoming else None)
+
+    def _work(self):
+        while True:
+            job = self._ready.get()
+            if job is None or self._stopping.is_set():
+                with self._cond:
+                    if job is None and not self._stopping.is_set():
+                        self._retiring -= 1
+                    self._threads.remove(current_thread())
+                return
+            self._run(job)
+
+    def _run(self, job):
+        with self._cond:
+            job.state = 'running'
+            job.last_started = utc_timestamp()
+        start = time.monotonic()
+        error = None
         try:
-            # Connect to database
-            conn = sqlite3.connect('db/users.db')
-            c = conn.cursor()
-            
-            # Get a random username from the list
-            random_username = random.choice(usernames)
-            
-            # Get the user_id for the random username
-            c.execute('SELECT id FROM users WHERE username = ?', (random_username,))
-            user = c.fetchone()
-            
-            if user:
-                # Get random content for the post
-                content = get_random_post_content()
-                
-                # Create the post
-                c.execute(
-                    'INSERT INTO posts (user_id, content) VALUES (?, ?)',
-                    (user[0], content)
-                )
-                
-                # Get the created post details for the socket emission
-                post_id = c.lastrowid
-                c.execute('''
-                    SELECT 
-                        p.id,
-                        p.content,
-                        p.created_at,
-                        u.username,
-                        u.id as author_id,
-                        0 as likes,
-                        0 as liked
-                    FROM posts p
-                    JOIN users u ON p.user_id = u.id
-                    WHERE p.id = ?
-                ''', (post_id,))
-                
-                post = c.fetchone()
-                new_post = {
-                    'id': post[0],
-                    'content': post[1],
-                    'created_at': post[2],
-                    'username': post[3],
-                    'isAuthor': False,
-                    'likes': post[5],
-                    'liked': bool(post[6])
-                }
-                
-                conn.commit()
-                
-                # Emit the new post to all connected clients
-                socketio.emit('new_post', new_post)
-                
-                print(f"Auto-posted as {random_username}: {content[:50]}...")
-                
+            job.fn()
         except Exception as e:
-            print(f"Error in auto posting: {e}")
-        finally:
-            if 'conn' in locals():
-                conn.close()
-        
-        # Wait for 5 minutes before the next post
-        time.sleep(120)
+            error = e
+            print(f"Job {job.name} failed: {e}")
+        duration = time.monotonic() - start
+
+        metrics.observe('postible_job_duration_seconds', duration, (('job', job.name),))
+        metrics.inc('postible_job_runs_total',
+                    (('job', job.name), ('result', 'error' if error else 'ok')))
+        with self._cond:
+            job.running = False
+            job.runs += 1
+            job.last_duration = round(duration, 3)
+            now = time.monotonic()
+            if error:
+                job.failures += 1
+                job.consecutive_failures += 1
+                job.last_error = str(error)
+                if job.interval is None and job.consecutive_failures > job.max_retries:
+                    job.state = 'failed'
+                    job.next_run = None
+                else:
+                    delay = min(JOB_RETRY_MAX, JOB_RETRY_BASE * 2 ** (job.consecutive_failures - 1))
+                    job.state = 'retrying'
+                    job.next_run = now + job.jittered(min(delay, job.interval or delay))
+            else:
+                job.consecutive_failures = 0
+                if job.interval is None:
+                    job.state = 'done'
+                    job.next_run = None
+                else:
+                    job.state = 'scheduled'
+                    job.next_run = now + job.jittered(job.interval)
+            self._cond.notify()
+
+    def status(self):
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'jobs': [job.snapshot() for job in self._jobs.values()]
+            }
+
+scheduler = Scheduler(SCHEDULER_WORKERS)
+
+def schedule_background_jobs(seed):
+    """Register the leader's jobs; seeding runs once, in the background"""
+    scheduler.start()
+    if seed:
+        scheduler.add('seed', initialize_with_seed_data, max_retries=0)
+    scheduler.add('auto_post', auto_post_content,
+                  interval=AUTO_POST_INTERVAL, delay=AUTO_POST_INTERVAL)
+    if ARCHIVE_AFTER_DAYS > 0:
+        scheduler.add('archive', archive_old_posts, interval=ARCHIVE_INTERVAL, delay=60)
+    scheduler.add('dedupe', dedupe_posts, delay=30)
+
+@app.route('/jobs')
+def get_jobs():
+    """Background job status and run times"""
+    return jsonify(scheduler.status())
+
+def may_control_jobs():
+    """Whether the request carries JOBS_TOKEN or, when none is set, was made
+    on this machine without going through a proxy, which would make every
+    remote client look local"""
+    if JOBS_TOKEN:
+        return hmac.compare_digest(request.headers.get('Authorization', ''),
+                                   f'Bearer {JOBS_TOKEN}')
+    return (request.remote_addr in ('127.0.0.1', '::1')
+            and 'X-Forwarded-For' not in request.headers
+            and 'Forwarded' not in request.headers)
+
+@app.route('/jobs/<name>/<action>', methods=['POST'])
+def control_job(name, action):
+    """Pause, resume or trigger a job; see may_control_jobs"""
+    if not may_control_jobs():
+        return jsonify({'error': 'Forbidden'}), 403
+    if name not in {job['name'] for job in scheduler.status()['jobs']}:
+        return jsonify({'error': 'Job not found'}), 404
+    actions = {'pause': scheduler.pause, 'resume': scheduler.resume, 'run': scheduler.run_now}
+    if action not in actions:
+        return jsonify({'error': 'Action must be pause, resume or run'}), 400
+    actions[action](name)
+    return jsonify(scheduler.status())
+
+# One-off jobs that /ready waits for; dedupe is maintenance and may run long
+STARTUP_JOBS = ('seed',)
+
+@app.route('/ready')
+def get_ready():
+    """Readiness probe: 200 once the schema is migrated and this worker's
+    STARTUP_JOBS have finished; 503 until then"""
+    checks = {'database': db_ready.is_set()}
+    for job in scheduler.status()['jobs']:
+        if job['name'] in STARTUP_JOBS:
+            checks[job['name']] = job['status'] in ('done', 'failed')
+    ready = all(checks.values())
+    return jsonify({
+        'ready': ready,
+        'checks': checks,
+        'content_buffer': content_buffer.stats()['size']
+    }), 200 if ready else 503
+
+LEADER_LOCK_PATH = 'db/leader.lock'
+# How often a standby worker checks whether the leader has gone away
+LEADER_RETRY_SECONDS = 15
+
+_leader_lock_file = None
+
+def acquire_leader_lock():
+    """Try to become the one worker that runs the background jobs.
+
+    Uses a non-blocking flock, which the OS releases when the process
+    exits, so a standby worker can take over from a dead leader.
+    """
+    global _leader_lock_file
+    lock_file = open(LEADER_LOCK_PATH, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _leader_lock_file = lock_file
+    return True
+
+def await_leadership():
+    """Standby loop: take over the background jobs once the leader exits"""
+    while not acquire_leader_lock():
+        time.sleep(LEADER_RETRY_SECONDS)
+    print("Took over the background jobs from the previous leader")
+    content_buffer.start()
+    schedule_background_jobs(seed=False)
+
+def start_background_jobs():
+    """Seed and start auto-posting and archiving in the elected worker only"""
+    if acquire_leader_lock():
+        content_buffer.start()
+        schedule_background_jobs(seed=True)
+    else:
+        print("Another worker runs the background jobs, standing by")
+        Thread(target=await_leadership, daemon=True).start()
 
-def start_auto_posting():
-    """Start the auto-posting thread"""
-    auto_post_thread = Thread(target=auto_post_content, daemon=True)
-    auto_post_thread.start()
+def exit_on_sigterm(signum, frame):
+    # Exit through atexit; a second SIGTERM kills without waiting
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    sys.exit(0)
 
 if __name__ == '__main__':
-    init_db()
-    initialize_with_seed_data()
-    start_auto_posting()
-    socketio.run(app, debug=True, host='0.0.0.0', port=80)
\ No newline at end of file
+    debug = os.environ.get('POSTIBLE_DEBUG', '1') == '1'
+    # In debug mode the reloader's parent process only watches files and
+    # restarts the child that serves requests, so the child does the rest
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        init_db()
+        # Flush queued events even if no client ever connects to this worker
+        event_batcher.start()
+        if read_snapshot:
+            read_snapshot.start()
+        # Benchmarks and other tooling turn off seeding and auto-posting
+        if os.environ.get('POSTIBLE_BACKGROUND_JOBS', '1') == '1':
+            start_background_jobs()
+    # Give running jobs a chance to finish on Ctrl+C or SIGTERM
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    atexit.register(scheduler.shutdown)
+    socketio.run(app,
+                 debug=debug,
+                 host=os.environ.get('POSTIBLE_HOST', '0.0.0.0'),
+                 port=int(os.environ.get('POSTIBLE_PORT', 80)))
\ No newline at end of file
@@ -0,0 +1,438 @@
+"""
+Load-testing harness for app.py.
+
+Seeds a throwaway database at the requested scale (without going through
+create_seed_posts and its network fetches), starts the app on it in a
+subprocess, and drives the HTTP routes with concurrent clients while a set
+of socket.io listeners measure how long new_post and like_update events
+take to reach them.
+
+Before the load starts, the query plans of the feed queries are checked
+against the seeded database: each must walk its index without a sort step.
+
+Results are printed and saved as JSON under bench_results/, and compared
+against the previous run so regressions between versions stand out.
+
+    python benchmark.py --users 200 --posts 100000 --likes 300000 \
+        --clients 32 --listeners 100 --duration 30
+
+The socket.io listeners use long-polling unless the websocket-client
+package is installed.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import requests
+import socketio
+
+APP_DIR = Path(__file__).resolve().parent
+RESULTS_DIR = APP_DIR / 'bench_results'
+BENCH_PASSWORD = 'bench-password'
+
+# Relative weights of the operations each client performs
+OPERATION_WEIGHTS = {
+    'feed': 50,
+    'feed_my': 10,
+    'feed_liked': 10,
+    'feed_timeline': 10,
+    'like': 20,
+    'create_post': 5,
+    'signin': 5
+}
+
+# Vocabulary of the synthetic post content
+WORDS = ('quantum lunar coffee garden python river jazz orbit pixel forest '
+         'signal harbor violet engine cactus meadow rocket canyon ember '
+         'glacier').split()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(latencies, duration):
+    """Latency percentiles in milliseconds plus throughput"""
+    return {
+        'count': len(latencies),
+        'throughput': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None
+    }
+
+
+# The index each feed query has to walk, with the parameters of a first page
+QUERY_PLANS = {
+    'feed': ('FEED_SQL', 'idx_posts_created', lambda app: (*app.FIRST_PAGE_CURSOR, 21)),
+    'feed_my': ('MY_FEED_SQL', 'idx_posts_user_created',
+                lambda app: (1, *app.FIRST_PAGE_CURSOR, 21)),
+    'feed_liked': ('LIKED_FEED_SQL', 'idx_likes_user_created',
+                   lambda app: (1, *app.FIRST_PAGE_CURSOR, 21)),
+    'feed_timeline': ('TIMELINE_SQL', 'PRIMARY KEY',
+                      lambda app: (1, *app.FIRST_PAGE_CURSOR, 21))
+}
+
+
+def check_query_plans(app, conn):
+    """EXPLAIN QUERY PLAN each feed query; return a list of problems"""
+    problems = []
+    for name, (attr, index, params) in QUERY_PLANS.items():
+        plan = [row[3] for row in conn.execute(
+            'EXPLAIN QUERY PLAN ' + getattr(app, attr), params(app))]
+        print(f"{name}: " + ' | '.join(plan))
+        if not any(index in step for step in plan):
+            problems.append(f"{name} does not use {index}")
+        if any('TEMP B-TREE' in step for step in plan):
+            problems.append(f"{name} sorts through a temp b-tree")
+        if any(step.startswith('SCAN') and 'USING' not in step for step in plan):
+            problems.append(f"{name} scans a table")
+    return problems
+
+
+def seed_database(workdir, users, posts, likes, follows):
+    """Create the schema through app.init_db and bulk-insert synthetic data"""
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        sys.path.insert(0, str(APP_DIR))
+        import app
+        app.init_db()
+
+        start = time.monotonic()
+        with app.db_pool.connection() as conn:
+            password = app.hash_password(BENCH_PASSWORD)
+            conn.executemany(
+                'INSERT INTO users (username, password) VALUES (?, ?)',
+                ((f'bench{i}', password) for i in range(users)))
+
+            # Spread posts over the last 30 days, oldest first
+            now = datetime.utcnow()
+            step = timedelta(days=30) / max(posts, 1)
+            conn.executemany(
+                'INSERT INTO posts (user_id, content, created_at) VALUES (?, ?, ?)',
+                ((random.randint(1, users),
+                  f'Benchmark post {i} about ' + ' '.join(random.sample(WORDS, 6)),
+                  (now - step * (posts - i)).strftime('%Y-%m-%d %H:%M:%S'))
+                 for i in range(posts)))
+
+            pairs = set()
+            while len(pairs) < likes:
+                pairs.add((random.randint(1, users), random.randint(1, posts)))
+            conn.executemany(
+                '''
+                INSERT OR IGNORE INTO likes (user_id, post_id)
+                SELECT ?, id FROM posts WHERE id = ? AND user_id != ?
+                ''',
+                ((user_id, post_id, user_id) for user_id, post_id in pairs))
+
+            conn.executemany(
+                'INSERT INTO follows (follower_id, followee_id) VALUES (?, ?)',
+                ((user_id, followee_id) for user_id in range(1, users + 1)
+                 for followee_id in random.sample(
+                     [other for other in range(1, users + 1) if other != user_id],
+                     min(follows, users - 1))))
+            # Materialize the timelines the way the post writer would have
+            conn.execute('''
+                INSERT INTO timeline (user_id, created_at, post_id)
+                SELECT user_id, created_at, id FROM posts
+                UNION
+                SELECT f.follower_id, p.created_at, p.id
+                FROM posts p JOIN follows f ON f.followee_id = p.user_id
+            ''')
+            conn.commit()
+            print(f"Seeded {users} users, {posts} posts, {likes} likes, "
+                  f"{follows} follows per user in {time.monotonic() - start:.1f}s")
+
+            conn.execute('ANALYZE')
+            problems = check_query_plans(app, conn)
+            if problems:
+                raise SystemExit('Query plan check failed: ' + '; '.join(problems))
+    finally:
+        os.chdir(cwd)
+
+
+def start_server(workdir, port):
+    env = dict(os.environ,
+               POSTIBLE_PORT=str(port),
+               POSTIBLE_HOST='127.0.0.1',
+               POSTIBLE_DEBUG='0',
+               POSTIBLE_BACKGROUND_JOBS='0',
+               POSTIBLE_RATE_LIMITING='0')
+    server = subprocess.Popen([sys.executable, str(APP_DIR / 'app.py')],
+                              cwd=workdir, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    start = time.monotonic()
+    url = f'http://127.0.0.1:{port}'
+    served = None
+    while time.monotonic() - start < 30:
+        try:
+            response = requests.get(url + '/ready', timeout=1)
+        except requests.ConnectionError:
+            time.sleep(0.05)
+            continue
+        # Time to the first served request, then to background init done
+        served = served or time.monotonic() - start
+        if response.status_code == 200:
+            return server, url, served, time.monotonic() - start
+        time.sleep(0.05)
+    server.kill()
+    raise RuntimeError('Server was not ready within 30 seconds')
+
+
+class Recorder:
+    """Thread-safe store of latencies and socket delivery times"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {op: [] for op in OPERATION_WEIGHTS}
+        self.errors = {op: 0 for op in OPERATION_WEIGHTS}
+        # Start times of the write requests, keyed by post id, and the delay
+        # until each listener received the matching event
+        self.sent = {'new_post': {}, 'like_update': {}}
+        self.fanout = {'new_post': [], 'like_update': []}
+
+    def record(self, op, latency, ok):
+        with self.lock:
+            self.latencies[op].append(latency)
+            if not ok:
+                self.errors[op] += 1
+
+    def mark_sent(self, event, post_id, at):
+        # Like updates are coalesced server-side, so measure from the latest
+        # write of the post rather than the first
+        with self.lock:
+            self.sent[event][post_id] = at
+
+    def mark_received(self, event, post_id, at):
+        with self.lock:
+            sent = self.sent[event].get(post_id)
+            if sent is not None:
+                self.fanout[event].append(at - sent)
+
+
+def signin(http, url, username):
+    response = http.post(f'{url}/signin',
+                         json={'username': username, 'password': BENCH_PASSWORD})
+    response.raise_for_status()
+
+
+def run_client(url, username, max_post_id, deadline, recorder, mix):
+    http = requests.Session()
+    signin(http, url, username)
+    operations = list(mix)
+    weights = list(mix.values())
+
+    while time.monotonic() < deadline:
+        op = random.choices(operations, weights)[0]
+        start = time.monotonic()
+        try:
+            if op == 'feed':
+                response = http.get(f'{url}/posts')
+            elif op == 'feed_my':
+                response = http.get(f'{url}/posts/my')
+            elif op == 'feed_liked':
+                response = http.get(f'{url}/posts/liked')
+            elif op == 'feed_timeline':
+                response = http.get(f'{url}/posts/timeline')
+            elif op == 'like':
+                post_id = random.randint(1, max_post_id)
+                recorder.mark_sent('like_update', post_id, start)
+                response = http.post(f'{url}/posts/{post_id}/like')
+            elif op == 'create_post':
+                response = http.post(f'{url}/posts', json={
+                    'content': 'Load test post ' + ' '.join(random.sample(WORDS, 4))})
+                if response.ok:
+                    recorder.mark_sent('new_post', response.json()['id'], start)
+            else:
+                response = http.post(f'{url}/signin', json={
+                    'username': username, 'password': BENCH_PASSWORD})
+            # 400/404 on likes (own post, deleted post) are expected outcomes
+            ok = response.status_code < 500
+        except requests.RequestException:
+            ok = False
+        recorder.record(op, time.monotonic() - start, ok)
+
+
+def measure_first_load(url, username):
+    """Bytes on the wire and time to fetch the dashboard, its static assets
+    and the first feed page, once uncompressed and once compressed"""
+    http = requests.Session()
+    signin(http, url, username)
+    html = http.get(f'{url}/', headers={'Accept-Encoding': 'identity'}).text
+    paths = ['/', *re.findall(r'(?:href|src)="(/static/[^"]+)"', html), '/posts']
+
+    # Warm up the feed cache and the precompressed static files first
+    for path in paths:
+        http.get(url + path)
+
+    results = {}
+    for name, accept in (('identity', 'identity'), ('compressed', 'br, gzip')):
+        wire = 0
+        start = time.monotonic()
+        for path in paths:
+            response = http.get(url + path, headers={'Accept-Encoding': accept}, stream=True)
+            wire += len(response.raw.read(decode_content=False))
+        results[name] = {'bytes': wire, 'ms': round((time.monotonic() - start) * 1000, 1)}
+    return results
+
+
+def connect_listener(url, username, recorder):
+    http = requests.Session()
+    signin(http, url, username)
+    client = socketio.Client(reconnection=False)
+
+    @client.on('new_post')
+    def on_new_post(posts):
+        now = time.monotonic()
+        for post in posts if isinstance(posts, list) else [posts]:
+            recorder.mark_received('new_post', post['id'], now)
+
+    @client.on('like_update')
+    def on_like_update(updates):
+        now = time.monotonic()
+        for update in updates if isinstance(updates, list) else [updates]:
+            recorder.mark_received('like_update', update['post_id'], now)
+
+    cookie = '; '.join(f'{name}={value}' for name, value in http.cookies.items())
+    client.connect(url, headers={'Cookie': cookie})
+    # New posts only reach the timelines of the author's followers
+    client.emit('set_view', {'view': 'timeline'})
+    return client
+
+
+def previous_result():
+    if not RESULTS_DIR.exists():
+        return None
+    results = sorted(RESULTS_DIR.glob('*.json'))
+    return results[-1] if results else None
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_report(result, baseline):
+    print(f"\n{'operation':<14}{'count':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    sections = [('ops', result['ops']), ('fanout', result['fanout'])]
+    for section, rows in sections:
+        for name, row in rows.items():
+            line = (f"{name:<14}{row['count']:>8}{row['throughput']:>9}"
+                    f"{str(row['p50_ms']):>10}{str(row['p95_ms']):>10}{str(row['p99_ms']):>10}")
+            before = (baseline or {}).get(section, {}).get(name, {}).get('p95_ms')
+            if before and row['p95_ms']:
+                line += f"   p95 {row['p95_ms'] - before:+.2f} ms vs baseline"
+            print(line)
+    print(f"\nTotal throughput: {result['throughput']} req/s, "
+          f"errors: {sum(result['errors'].values())}, "
+          f"server start: {result['startup_s']}s, ready: {result['ready_s']}s")
+    first_load = result['first_load']
+    print(f"First load: {first_load['identity']['bytes'] / 1024:.1f} KB in "
+          f"{first_load['identity']['ms']} ms uncompressed, "
+          f"{first_load['compressed']['bytes'] / 1024:.1f} KB in "
+          f"{first_load['compressed']['ms']} ms compressed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--likes', type=int, default=30000)
+    parser.add_argument('--follows', type=int, default=20, help='accounts each user follows')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent HTTP clients')
+    parser.add_argument('--listeners', type=int, default=20, help='socket.io listeners')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load')
+    parser.add_argument('--operations', default=','.join(OPERATION_WEIGHTS),
+                        help='comma-separated subset of the operation mix, e.g. '
+                        '"signin" to measure login throughput alone')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--baseline', type=Path, help='result file to compare against '
+                        '(defaults to the latest one in bench_results/)')
+    parser.add_argument('--no-save', action='store_true', help="don't write a result file")
+    parser.add_argument('--startup-target', type=float, default=2.0,
+                        help='fail when the server takes longer than this many seconds '
+                        'to serve its first request')
+    args = parser.parse_args()
+    mix = {op: OPERATION_WEIGHTS[op] for op in args.operations.split(',')}
+
+    baseline_path = args.baseline or previous_result()
+    with tempfile.TemporaryDirectory() as workdir:
+        (Path(workdir) / 'db').mkdir()
+        seed_database(workdir, args.users, args.posts, args.likes, args.follows)
+        server, url, startup, ready = start_server(workdir, args.port)
+        try:
+            first_load = measure_first_load(url, 'bench0')
+            recorder = Recorder()
+            listeners = [connect_listener(url, f'bench{i % args.users}', recorder)
+                         for i in range(args.listeners)]
+
+            start = time.monotonic()
+            deadline = start + args.duration
+            clients = [threading.Thread(target=run_client,
+                                        args=(url, f'bench{i % args.users}', args.posts,
+                                              deadline, recorder, mix))
+                       for i in range(args.clients)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            elapsed = time.monotonic() - start
+            # Let the last batched events arrive
+            time.sleep(1)
+            for listener in listeners:
+                listener.disconnect()
+        finally:
+            server.terminate()
+            server.wait(timeout=10)
+
+    result = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'args': {key: value for key, value in vars(args).items()
+                 if key not in ('baseline', 'no_save')},
+        'startup_s': round(startup, 2),
+        'ready_s': round(ready, 2),
+        'first_load': first_load,
+        'throughput': round(sum(len(v) for v in recorder.latencies.values()) / elapsed, 1),
+        'errors': recorder.errors,
+        'ops': {op: summarize(recorder.latencies[op], elapsed) for op in mix},
+        'fanout': {event: summarize(delays, elapsed)
+                   for event, delays in recorder.fanout.items()}
+    }
+
+    baseline = json.loads(baseline_path.read_text()) if baseline_path else None
+    print_report(result, baseline)
+    if baseline_path:
+        print(f"Baseline: {baseline_path}")
+
+    if not args.no_save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        name = f"{datetime.now():%Y%m%d-%H%M%S}-{result['revision'] or 'unknown'}.json"
+        path = RESULTS_DIR / name
+        path.write_text(json.dumps(result, indent=2))
+        print(f"Saved {path}")
+
+    if startup > args.startup_target:
+        raise SystemExit(f"Server start took {startup:.2f}s, "
+                         f"over the {args.startup_target}s target")
+
+
+if __name__ == '__main__':
+    main()
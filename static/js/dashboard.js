@@ -1,6 +1,23 @@
+let socket = null;
+
 document.addEventListener('DOMContentLoaded', () => {
     // Initialize Socket.IO
-    const socket = io();
+    socket = io();
+
+    // Tell the server which view we show (again after a reconnect), so it
+    // only sends us the events that view cares about, then fetch whatever
+    // we missed while disconnected
+    socket.on('connect', () => {
+        socket.emit('set_view', { view: FEED_VIEWS[feed.endpoint] });
+        catchUp();
+    });
+
+    // Events aren't delivered reliably to background tabs either
+    document.addEventListener('visibilitychange', () => {
+        if (document.visibilityState === 'visible') {
+            catchUp();
+        }
+    });
     
     // User menu functionality
     const userMenuBtn = document.getElementById('userMenuBtn');
@@ -9,13 +26,27 @@ document.addEventListener('DOMContentLoaded', () => {
     const settingsBtn = document.getElementById('settingsBtn');
     const likedPostsBtn = document.getElementById('likedPostsBtn');
     const myPostsBtn = document.getElementById('myPostsBtn');
+    const followingBtn = document.getElementById('followingBtn');
     const newPostBtn = document.getElementById('newPostBtn');
     const modalOverlay = document.getElementById('modalOverlay');
     const postForm = document.getElementById('postForm');
     const appName = document.querySelector('.app-name');
 
-    // Load initial posts
-    loadInitialPosts();
+    // Note the current change sequence before loading posts, so nothing
+    // written in between can be missed
+    fetchChanges(null).then((changes) => {
+        lastSeq = changes.seq;
+    }).catch((error) => {
+        console.error('Failed to fetch change sequence:', error);
+    }).finally(loadInitialPosts);
+
+    // Load the next page when the bottom of the feed scrolls into view
+    const feedObserver = new IntersectionObserver((entries) => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadMorePosts();
+        }
+    }, { root: document.querySelector('.content-area'), rootMargin: '400px' });
+    feedObserver.observe(document.getElementById('feedSentinel'));
 
     // Add click event for app name
     appName.addEventListener('click', () => {
@@ -26,17 +57,24 @@ document.addEventListener('DOMContentLoaded', () => {
         // Reset active states of filter buttons
         likedPostsBtn.classList.remove('active');
         myPostsBtn.classList.remove('active');
+        followingBtn.classList.remove('active');
     });
 
 
-    // Listen for new posts via WebSocket
-    socket.on('new_post', (post) => {
-        addNewPost(post);
+    // Listen for new posts via WebSocket; the server sends them in batches
+    socket.on('new_post', (posts) => {
+        asList(posts).forEach(post => {
+            noteSeq(post.seq);
+            addNewPost(post);
+        });
     });
 
-    // Listen for like updates via WebSocket
-    socket.on('like_update', (data) => {
-        updatePostLikes(data);
+    // Listen for like updates via WebSocket, coalesced per post by the server
+    socket.on('like_update', (updates) => {
+        asList(updates).forEach(update => {
+            noteSeq(update.seq);
+            updatePostLikes(update);
+        });
     });
 
     // Toggle user menu
@@ -135,18 +173,10 @@ document.addEventListener('DOMContentLoaded', () => {
             loadInitialPosts();
         } else {
             // If not active, add active class and show only liked posts
-            try {
-                const response = await fetch('/posts/liked');
-                if (response.ok) {
-                    const posts = await response.json();
-                    displayPosts(posts);
-                    likedPostsBtn.classList.add('active');
-                    myPostsBtn.classList.remove('active');
-                } else {
-                    console.error('Failed to fetch liked posts');
-                }
-            } catch (error) {
-                console.error('Error fetching liked posts:', error);
+            if (await loadFeed('/posts/liked')) {
+                likedPostsBtn.classList.add('active');
+                myPostsBtn.classList.remove('active');
+                followingBtn.classList.remove('active');
             }
         }
     });
@@ -160,18 +190,27 @@ document.addEventListener('DOMContentLoaded', () => {
             loadInitialPosts();
         } else {
             // If not active, add active class and show only my posts
-            try {
-                const response = await fetch('/posts/my');
-                if (response.ok) {
-                    const posts = await response.json();
-                    displayPosts(posts);
-                    myPostsBtn.classList.add('active');
-                    likedPostsBtn.classList.remove('active');
-                } else {
-                    console.error('Failed to fetch my posts');
-                }
-            } catch (error) {
-                console.error('Error fetching my posts:', error);
+            if (await loadFeed('/posts/my')) {
+                myPostsBtn.classList.add('active');
+                likedPostsBtn.classList.remove('active');
+                followingBtn.classList.remove('active');
+            }
+        }
+    });
+
+    followingBtn.addEventListener('click', async () => {
+        const isCurrentlyActive = followingBtn.classList.contains('active');
+
+        if (isCurrentlyActive) {
+            // If already active, remove active class and show all posts
+            followingBtn.classList.remove('active');
+            loadInitialPosts();
+        } else {
+            // If not active, add active class and show the home timeline
+            if (await loadFeed('/posts/timeline')) {
+                followingBtn.classList.add('active');
+                likedPostsBtn.classList.remove('active');
+                myPostsBtn.classList.remove('active');
             }
         }
     });
@@ -183,18 +222,153 @@ function closeModal() {
     document.getElementById('postContent').value = '';
 }
 
-async function loadInitialPosts() {
+// Paging state of the feed currently on screen
+const feed = {
+    endpoint: '/posts',
+    nextCursor: null,
+    loading: false,
+    // Bumped on every view switch so responses for an old view are dropped
+    generation: 0
+};
+
+const PAGE_SIZE = 20;
+
+// Socket.IO view names of the feed endpoints
+const FEED_VIEWS = {
+    '/posts': 'all',
+    '/posts/my': 'my',
+    '/posts/liked': 'liked',
+    '/posts/timeline': 'timeline'
+};
+
+// Sequence number of the latest change applied to the page
+let lastSeq = null;
+let catchingUp = false;
+
+function noteSeq(seq) {
+    if (seq !== undefined && lastSeq !== null && seq > lastSeq) {
+        lastSeq = seq;
+    }
+}
+
+async function fetchChanges(since) {
+    const query = since === null ? '' : `?since=${since}`;
+    const response = await fetch(`/posts/changes${query}`);
+    if (!response.ok) {
+        throw new Error(`Failed to fetch changes: ${response.status}`);
+    }
+    return response.json();
+}
+
+// Whether a new post belongs in the view currently shown
+function showsNewPost(post) {
+    const view = FEED_VIEWS[feed.endpoint];
+    return view === 'all' || ((view === 'my' || view === 'timeline') && post.isAuthor);
+}
+
+// Apply the changes made since lastSeq, e.g. after a reconnect
+async function catchUp() {
+    if (lastSeq === null || catchingUp) {
+        return;
+    }
+    catchingUp = true;
     try {
-        const response = await fetch('/posts');
-        if (response.ok) {
-            const posts = await response.json();
-            displayPosts(posts);
+        let more = true;
+        while (more) {
+            const changes = await fetchChanges(lastSeq);
+            if (changes.reset) {
+                // Too far behind the change log; start over
+                lastSeq = changes.seq;
+                await loadFeed(feed.endpoint);
+                return;
+            }
+            if (FEED_VIEWS[feed.endpoint] === 'timeline' && changes.posts.length) {
+                // Only the server knows which new posts the timeline shows
+                lastSeq = (await fetchChanges(null)).seq;
+                await loadFeed(feed.endpoint);
+                return;
+            }
+            changes.posts.filter(showsNewPost).forEach(addNewPost);
+            changes.likes.forEach(updatePostLikes);
+            lastSeq = changes.seq;
+            more = changes.more;
         }
+    } catch (error) {
+        console.error('Failed to catch up:', error);
+    } finally {
+        catchingUp = false;
+    }
+}
+
+// Socket events may carry a single item or a batch
+function asList(payload) {
+    return Array.isArray(payload) ? payload : [payload];
+}
+
+async function fetchFeedPage(endpoint, cursor) {
+    const params = new URLSearchParams({ limit: PAGE_SIZE });
+    if (cursor) {
+        params.set('before', cursor);
+    }
+    const response = await fetch(`${endpoint}?${params}`);
+    if (!response.ok) {
+        throw new Error(`Failed to fetch ${endpoint}: ${response.status}`);
+    }
+    return response.json();
+}
+
+// Replace the feed with the first page of `endpoint`; resolves to true on success
+async function loadFeed(endpoint) {
+    const generation = ++feed.generation;
+    feed.loading = true;
+    try {
+        const page = await fetchFeedPage(endpoint, null);
+        if (generation !== feed.generation) {
+            return false;
+        }
+        feed.endpoint = endpoint;
+        feed.nextCursor = page.next_cursor;
+        displayPosts(page.posts);
+        if (socket) {
+            socket.emit('set_view', { view: FEED_VIEWS[endpoint] });
+        }
+        return true;
     } catch (error) {
         console.error('Failed to load posts:', error);
+        return false;
+    } finally {
+        if (generation === feed.generation) {
+            feed.loading = false;
+        }
+    }
+}
+
+async function loadMorePosts() {
+    if (feed.loading || !feed.nextCursor) {
+        return;
+    }
+    const generation = feed.generation;
+    feed.loading = true;
+    try {
+        const page = await fetchFeedPage(feed.endpoint, feed.nextCursor);
+        if (generation !== feed.generation) {
+            return;
+        }
+        feed.nextCursor = page.next_cursor;
+        appendPosts(page.posts);
+    } catch (error) {
+        console.error('Failed to load more posts:', error);
+    } finally {
+        if (generation === feed.generation) {
+            feed.loading = false;
+        }
     }
 }
 
+function loadInitialPosts() {
+    return loadFeed('/posts');
+}
+
 function displayPosts(posts) {
     const postsContainer = document.getElementById('postsContainer');
     postsContainer.innerHTML = ''; // Clear existing posts
@@ -204,7 +378,16 @@ function displayPosts(posts) {
         return;
     }
 
+    appendPosts(posts);
+}
+
+function appendPosts(posts) {
+    const postsContainer = document.getElementById('postsContainer');
     posts.forEach(post => {
+        // Skip posts already shown, e.g. ones that arrived over the socket
+        if (postsContainer.querySelector(`[data-post-id="${post.id}"]`)) {
+            return;
+        }
         const postElement = createPostElement(post);
         postsContainer.appendChild(postElement);
     });
@@ -212,6 +395,10 @@ function displayPosts(posts) {
 
 function addNewPost(post) {
     const postsContainer = document.getElementById('postsContainer');
+    if (postsContainer.querySelector(`[data-post-id="${post.id}"]`)) {
+        return;
+    }
+    post.isAuthor = post.username === document.getElementById('username').textContent;
     const noPostsMessage = postsContainer.querySelector('.no-posts');
     
     if (noPostsMessage) {
@@ -235,7 +422,7 @@ function createPostElement(post) {
 
     postDiv.innerHTML = `
         <div class="post-header">
-            <span class="post-author">${post.username}</span>
+            <span class="post-author" title="Follow or unfollow">${post.username}</span>
             <span class="post-date">${new Date(post.created_at).toLocaleDateString()}</span>
         </div>
         <div class="post-content">${postContent}</div>
@@ -245,6 +432,7 @@ function createPostElement(post) {
             </button>
         </div>
     `;
+    postDiv.querySelector('.post-author').addEventListener('click', () => toggleFollow(post.username));
     return postDiv;
 }
 
@@ -255,6 +443,40 @@ function convertUrlsToLinks(text) {
 }
 
 
+async function toggleFollow(username) {
+    if (username === document.getElementById('username').textContent) {
+        return;
+    }
+    try {
+        const response = await fetch(`/users/${encodeURIComponent(username)}/follow`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            }
+        });
+
+        if (response.status === 429) {
+            console.warn(`Follow rate limited, retry after ${response.headers.get('Retry-After')}s`);
+            return;
+        }
+
+        const result = await response.json();
+        if (!response.ok) {
+            alert(result.error || 'Failed to update follow');
+            return;
+        }
+
+        alert(result.following ? `You now follow ${username}` : `You unfollowed ${username}`);
+        // The timeline's posts and socket rooms both depend on who we follow
+        if (FEED_VIEWS[feed.endpoint] === 'timeline') {
+            await loadFeed(feed.endpoint);
+        }
+    } catch (error) {
+        console.error('Error toggling follow:', error);
+        alert('Failed to update follow. Please try again.');
+    }
+}
+
 async function toggleLike(postId) {
     try {
         const response = await fetch(`/posts/${postId}/like`, {
@@ -264,6 +486,12 @@ async function toggleLike(postId) {
             }
         });
 
+        if (response.status === 429) {
+            // Clicking faster than the like budget allows; the button keeps its state
+            console.warn(`Like rate limited, retry after ${response.headers.get('Retry-After')}s`);
+            return;
+        }
+
         if (!response.ok) {
             const error = await response.json();
             if (error.error === 'Cannot like your own post') {
@@ -271,7 +499,12 @@ async function toggleLike(postId) {
             } else {
                 alert(error.error || 'Failed to update like');
             }
+            return;
         }
+
+        // Broadcasts only carry counts, so our own liked state comes from here
+        const result = await response.json();
+        updatePostLikes({ post_id: postId, likes: result.likes, liked: result.liked });
     } catch (error) {
         console.error('Error toggling like:', error);
         alert('Failed to update like. Please try again.');
@@ -284,12 +517,8 @@ function updatePostLikes(data) {
         const likeButton = postElement.querySelector('.like-button');
         likeButton.innerHTML = `♥ ${data.likes}`;
         
-        if (data.user_id === parseInt(document.getElementById('username').dataset.userId)) {
-            if (data.action === 'liked') {
-                likeButton.classList.add('liked');
-            } else {
-                likeButton.classList.remove('liked');
-            }
+        if (data.liked !== undefined) {
+            likeButton.classList.toggle('liked', data.liked);
         }
     }
 }
\ No newline at end of file
@@ -0,0 +1,26 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """The app module, migrated, with its databases in a temporary directory.
+
+    app.py opens db/ relative to the working directory, so the tests run
+    from there.
+    """
+    workdir = tmp_path_factory.mktemp('postible')
+    (workdir / 'db').mkdir()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    # Tests that need it turn rate limiting back on
+    os.environ.setdefault('POSTIBLE_RATE_LIMITING', '0')
+    import app
+    app.init_db()
+    yield app
+    os.chdir(cwd)
@@ -0,0 +1,52 @@
+"""Archiving and compacting the hot database"""
+import math
+
+
+def test_incremental_vacuum_frees_a_step_of_pages_per_call(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'ARCHIVE_BATCH_PAUSE', 0)
+    pool = app.ConnectionPool(str(tmp_path / 'vacuum.db'), 1)
+    with pool.connection() as conn:
+        conn.execute('CREATE TABLE filler (data BLOB)')
+        conn.executemany('INSERT INTO filler VALUES (?)', [(b'x' * 4000,) for _ in range(3000)])
+        conn.commit()
+        conn.execute('DELETE FROM filler')
+        conn.commit()
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        assert free > 2 * app.VACUUM_STEP_PAGES
+
+        steps = []
+        executescript = conn.executescript
+        conn.executescript = lambda sql: steps.append(sql) or executescript(sql)
+
+        assert app.incremental_vacuum(conn) == free
+        assert conn.execute('PRAGMA freelist_count').fetchone()[0] == 0
+        assert len(steps) == math.ceil(free / app.VACUUM_STEP_PAGES)
+
+
+def test_feed_pages_run_on_across_the_archive_boundary(app):
+    with app.db_pool.connection() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO users (username, password) VALUES ('archive-author', 'x')")
+        user_id = c.lastrowid
+        c.executemany('INSERT INTO posts (user_id, content, created_at) VALUES (?, ?, ?)',
+                      [(user_id, f'post {day}', f'2020-01-{day:02d} 12:00:00')
+                       for day in range(1, 11)])
+        conn.commit()
+        c.execute('SELECT id FROM posts WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
+        newest_first = [row[0] for row in c.fetchall()]
+
+        assert app.archive_batch(conn, '2020-01-06 00:00:00') == (5, 0)
+
+        seen, archived = [], []
+        cursor = app.FIRST_PAGE_CURSOR
+        while True:
+            rows = app.feed_rows(c, 'my', user_id, cursor, 3)
+            seen += [row[0] for row in rows[:3]]
+            archived += [row[7] for row in rows[:3]]
+            if len(rows) <= 3:
+                break
+            cursor = (rows[2][6], rows[2][0])
+
+        assert seen == newest_first
+        assert archived == [0] * 5 + [1] * 5
+        assert {row[3] for row in rows} == {'archive-author'}
@@ -0,0 +1,85 @@
+"""ContentFetcher against a local HTTP stub standing in for the content APIs"""
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """/ok answers at once, /slow after a second, /error with a 500"""
+
+    def do_GET(self):
+        self.server.hits[self.path] += 1
+        if self.path == '/error':
+            self.send_response(500)
+            self.end_headers()
+            return
+        if self.path == '/slow':
+            time.sleep(1)
+        body = json.dumps({'text': f'from {self.path}'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.hits = Counter()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def sources(stub, *paths):
+    return [{'url': f'http://127.0.0.1:{stub.server_port}{path}',
+             'parser': lambda r: r.json()['text']} for path in paths]
+
+
+def test_first_good_response_wins(app, stub):
+    fetcher = app.ContentFetcher(sources(stub, '/error', '/slow', '/ok'), fanout=3)
+    start = time.monotonic()
+    assert fetcher.fetch() == 'from /ok'
+    assert time.monotonic() - start < 0.9
+
+
+def test_overall_deadline_is_respected(app, stub):
+    fetcher = app.ContentFetcher(sources(stub, '/slow'), fanout=1, deadline=0.2)
+    start = time.monotonic()
+    assert fetcher.fetch() is None
+    assert time.monotonic() - start < 0.5
+
+
+def test_breaker_opens_and_lets_a_trial_through_after_cooldown(app, stub):
+    fetcher = app.ContentFetcher(sources(stub, '/error'), fanout=1)
+    breaker = fetcher.sources[0].breaker
+    for _ in range(breaker.threshold):
+        assert fetcher.fetch() is None
+    assert breaker.state == 'open'
+
+    # Open: the source is skipped without a request
+    assert fetcher.fetch() is None
+    assert stub.hits['/error'] == breaker.threshold
+
+    # Half-open after the cooldown: a failing trial opens it again
+    breaker.opened_at -= breaker.cooldown
+    assert breaker.state == 'half-open'
+    assert fetcher.fetch() is None
+    assert stub.hits['/error'] == breaker.threshold + 1
+    assert breaker.state == 'open'
+
+    # and a successful one closes it
+    breaker.opened_at -= breaker.cooldown
+    fetcher.sources[0].source['url'] = sources(stub, '/ok')[0]['url']
+    assert fetcher.fetch() == 'from /ok'
+    assert breaker.state == 'closed'
@@ -0,0 +1,31 @@
+"""Leader election between worker processes sharing the db directory"""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+
+LEADER = '''
+import sys
+import app
+print(app.acquire_leader_lock(), flush=True)
+sys.stdin.read()
+'''
+
+
+def test_one_worker_leads_and_another_takes_over_when_it_exits(app, monkeypatch):
+    monkeypatch.setattr(app, '_leader_lock_file', None)
+    env = dict(os.environ, PYTHONPATH=str(REPO))
+    leader = subprocess.Popen([sys.executable, '-c', LEADER], cwd=os.getcwd(), env=env,
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        assert leader.stdout.readline().strip() == 'True'
+        assert not app.acquire_leader_lock()
+    finally:
+        leader.stdin.close()
+        leader.wait(timeout=30)
+
+    # The lock went away with the leader's process
+    assert app.acquire_leader_lock()
+    app._leader_lock_file.close()
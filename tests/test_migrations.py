@@ -0,0 +1,65 @@
+"""Schema migrations applied to a database from before they were versioned"""
+import sqlite3
+
+
+def create_unversioned_database(path):
+    """The tables and rows of a database written by the original init_db()"""
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        );
+        CREATE TABLE likes (
+            user_id INTEGER NOT NULL,
+            post_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, post_id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (post_id) REFERENCES posts (id)
+        );
+        INSERT INTO users (username, password) VALUES ('alice', 'x'), ('bob', 'y');
+        INSERT INTO posts (user_id, content) VALUES
+            (1, 'hello from alice'), (1, 'second post'), (2, 'hello from bob');
+        INSERT INTO likes (user_id, post_id) VALUES (1, 3), (2, 1), (2, 3);
+    ''')
+    conn.close()
+
+
+def test_migrate_upgrades_an_unversioned_database(app, tmp_path):
+    create_unversioned_database(tmp_path / 'old.db')
+    pool = app.ConnectionPool(str(tmp_path / 'old.db'), 1, str(tmp_path / 'old_archive.db'))
+    with pool.connection() as conn:
+        app.migrate(conn)
+        c = conn.cursor()
+
+        assert app.schema_version(c) == len(app.MIGRATIONS)
+        c.execute('SELECT name FROM schema_migrations ORDER BY version')
+        assert [row[0] for row in c.fetchall()] == [m.__name__ for m in app.MIGRATIONS]
+
+        # Existing rows are kept and the derived columns and tables backfilled
+        c.execute('SELECT id, like_count FROM posts ORDER BY id')
+        assert c.fetchall() == [(1, 1), (2, 0), (3, 2)]
+        c.execute("SELECT rowid FROM posts_fts WHERE posts_fts MATCH 'hello' ORDER BY rowid")
+        assert c.fetchall() == [(1,), (3,)]
+        c.execute('SELECT user_id, post_id FROM timeline ORDER BY post_id')
+        assert c.fetchall() == [(1, 1), (1, 2), (2, 3)]
+        c.execute('SELECT follower_count, fanout_on_read FROM users ORDER BY id')
+        assert c.fetchall() == [(0, 0), (0, 0)]
+
+        c.execute('PRAGMA auto_vacuum')
+        assert c.fetchone()[0] == 2
+
+        # A second start has nothing left to apply
+        app.migrate(conn)
+        c.execute('SELECT COUNT(*) FROM schema_migrations')
+        assert c.fetchone()[0] == len(app.MIGRATIONS)
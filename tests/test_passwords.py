@@ -0,0 +1,65 @@
+"""Password hashing and the upgrade of stored hashes at signin"""
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+def test_verify_password_matches_scrypt_hashes(app):
+    stored = app.hash_password('secret')
+    assert stored.startswith('scrypt$')
+    assert app.verify_password('secret', stored) == (True, False)
+    assert app.verify_password('wrong', stored) == (False, False)
+
+
+def test_legacy_sha256_hash_needs_a_rehash(app):
+    legacy = hashlib.sha256(b'secret').hexdigest()
+    assert app.verify_password('secret', legacy) == (True, True)
+    assert app.verify_password('wrong', legacy) == (False, True)
+
+
+def test_changed_cost_parameters_need_a_rehash(app, monkeypatch):
+    stored = app.hash_password('secret')
+    monkeypatch.setattr(app, 'SCRYPT_N', app.SCRYPT_N * 2)
+    assert app.verify_password('secret', stored) == (True, True)
+
+
+def test_signin_upgrades_a_legacy_hash(app):
+    with app.db_pool.connection() as conn:
+        conn.execute('INSERT INTO users (username, password) VALUES (?, ?)',
+                     ('legacy-user', hashlib.sha256(b'secret').hexdigest()))
+        conn.commit()
+
+    client = app.app.test_client()
+    response = client.post('/signin', json={'username': 'legacy-user', 'password': 'secret'})
+    assert response.status_code == 200
+
+    with app.db_pool.connection() as conn:
+        stored = conn.execute('SELECT password FROM users WHERE username = ?',
+                              ('legacy-user',)).fetchone()[0]
+    assert stored.startswith('scrypt$')
+    assert app.verify_password('secret', stored) == (True, False)
+
+
+def test_unknown_username_is_rejected_after_a_hash(app, monkeypatch):
+    checked = []
+    verify_password = app.verify_password
+    monkeypatch.setattr(app, 'verify_password',
+                        lambda password, stored: checked.append(stored)
+                        or verify_password(password, stored))
+
+    client = app.app.test_client()
+    response = client.post('/signin', json={'username': 'nobody', 'password': 'secret'})
+    assert response.status_code == 401
+    assert checked == [app.DUMMY_PASSWORD_HASH]
+
+
+def test_concurrent_signins_all_succeed(app):
+    client = app.app.test_client()
+    for i in range(8):
+        client.post('/signup', json={'username': f'load-{i}', 'password': 'secret'})
+
+    def signin(i):
+        return app.app.test_client().post(
+            '/signin', json={'username': f'load-{i}', 'password': 'secret'}).status_code
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert list(executor.map(signin, range(8))) == [200] * 8
@@ -0,0 +1,16 @@
+"""The feed queries must walk their index without a sort step.
+
+Runs benchmark.check_query_plans against a small database seeded the way
+the benchmark seeds it, without starting a server.
+"""
+import os
+
+import benchmark
+
+
+def test_feed_queries_walk_their_indexes(app):
+    # Raises SystemExit if a plan check fails
+    benchmark.seed_database(os.getcwd(), users=20, posts=2000, likes=2000, follows=5)
+
+    with app.db_pool.connection() as conn:
+        assert benchmark.check_query_plans(app, conn) == []
@@ -0,0 +1,34 @@
+"""Token bucket rate limiting"""
+
+
+def test_refused_request_takes_no_tokens(app):
+    limiter = app.RateLimiter({'post': {'user': [2, 60], 'ip': [3, 60]}}, 100)
+    keys = (('user', 1), ('ip', '10.0.0.1'))
+    assert limiter.check('post', keys) == 0
+    assert limiter.check('post', keys) == 0
+    # The user bucket is empty; the ip bucket keeps its last token
+    assert limiter.check('post', keys) > 0
+    assert limiter.check('post', (('user', 2), ('ip', '10.0.0.1'))) == 0
+    assert limiter.check('post', (('user', 3), ('ip', '10.0.0.1'))) > 0
+    assert limiter.stats()['limited'] == {'post': 2}
+
+
+def test_cost_is_charged_in_full(app):
+    limiter = app.RateLimiter({'post': {'user': [30, 60]}}, 100)
+    # A batch larger than the bucket goes through once it is full...
+    assert limiter.check('post', (('user', 1),), cost=100) == 0
+    # ...and the debt has to be paid back before the next post
+    assert limiter.check('post', (('user', 1),)) > 100
+
+
+def test_route_answers_429_with_retry_after(app, monkeypatch):
+    monkeypatch.setattr(app, 'RATE_LIMITING', True)
+    monkeypatch.setattr(app, 'rate_limiter',
+                        app.RateLimiter({'signin': {'ip': [2, 60]}}, 100))
+    client = app.app.test_client()
+    login = {'username': 'nobody', 'password': 'secret'}
+    assert client.post('/signin', json=login).status_code == 401
+    assert client.post('/signin', json=login).status_code == 401
+    response = client.post('/signin', json=login)
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) == 30